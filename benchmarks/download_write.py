@@ -0,0 +1,120 @@
+"""
+Measures how fast a downloaded image is written to disk, through the old
+path (a new bytes object for every 16 KiB chunk of response.stream) and
+through PartialDownload reading into a reusable buffer of a few sizes. The
+image is served by a local HTTP server, and both paths hash what they write.
+
+Usage: python benchmarks/download_write.py [size in MiB] [runs]
+"""
+
+import hashlib
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable
+
+import urllib3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from partial_download import PartialDownload  # noqa: E402
+from transfer_stats import counted_readinto, counted_stream  # noqa: E402
+
+
+def start_server(body: bytes) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: object) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_stream(response: urllib3.HTTPResponse, folder: Path) -> str:
+    md5 = hashlib.md5()
+    with open(folder / "image.png", "wb") as f:
+        for chunk in counted_stream(response, 16384):
+            f.write(chunk)
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def write_readinto(buffer_size: int) -> Callable[[urllib3.HTTPResponse, Path], str]:
+    def write(response: urllib3.HTTPResponse, folder: Path) -> str:
+        partial = PartialDownload(folder, "image.png")
+        buffer = bytearray(buffer_size)
+        with partial.open(response):
+            for chunk in counted_readinto(response, buffer):
+                partial.write(chunk)
+
+        return partial.hexdigest()
+
+    return write
+
+
+def measure(
+    name: str,
+    url: str,
+    size: int,
+    md5: str,
+    runs: int,
+    write: Callable[[urllib3.HTTPResponse, Path], str],
+) -> None:
+    http = urllib3.PoolManager()
+    times = []
+    with tempfile.TemporaryDirectory() as folder:
+        for _ in range(runs):
+            start = time.perf_counter()
+            response = http.request("GET", url, preload_content=False)
+            digest = write(response, Path(folder))
+            times.append(time.perf_counter() - start)
+            response.release_conn()
+
+            assert digest == md5, f"{name} wrote a different file"
+
+    median = statistics.median(times)
+    print(f"{name}: {median * 1000:.1f} ms, {size / median / 2**20:.0f} MiB/s")
+
+
+def main() -> None:
+    size = int(sys.argv[1]) * 2**20 if len(sys.argv) > 1 else 20 * 2**20
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+
+    body = os.urandom(size)
+    md5 = hashlib.md5(body).hexdigest()
+    server = start_server(body)
+    url = f"http://127.0.0.1:{server.server_port}/image.png"
+
+    print(f"{size / 2**20:.0f} MiB image, median of {runs} runs")
+
+    measure("stream(16384)", url, size, md5, runs, write_stream)
+    for buffer_size in (16384, 262144, 1048576):
+        measure(
+            f"readinto({buffer_size})",
+            url,
+            size,
+            md5,
+            runs,
+            write_readinto(buffer_size),
+        )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Measures the memory used per queued image info, as a list of (md5, url)
+tuples and as an ImageInfoBuffer.
+
+Usage: python benchmarks/queue_memory.py [entries]
+"""
+
+import hashlib
+import os
+import sys
+import tracemalloc
+from typing import Callable, Iterator, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from image_info_buffer import ImageInfoBuffer  # noqa: E402
+
+
+def generate_image_infos(count: int) -> Iterator[Tuple[str, str]]:
+    for post_id in range(count):
+        image_hash = hashlib.md5(str(post_id).encode()).hexdigest()
+        image_url = (
+            f"https://konachan.com/image/{image_hash}/"
+            f"Konachan.com%20-%20{post_id}%20original%20scenic%20sky.png"
+        )
+        yield image_hash, image_url
+
+
+def measure(name: str, count: int, build: Callable[[int], object]) -> None:
+    tracemalloc.start()
+    container = build(count)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name}: {used / count:.1f} bytes per entry")
+    del container
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    print(f"{count} entries")
+
+    measure("List of tuples", count, lambda n: list(generate_image_infos(n)))
+    measure(
+        "ImageInfoBuffer", count, lambda n: ImageInfoBuffer(generate_image_infos(n))
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,94 +1,703 @@
+import codecs
 import json
+import math
+import os
+import threading
 import time
-from typing import Dict, List, Optional
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 from urllib.parse import quote_plus
 
 import urllib3
 
-from constants import BASE_URL
+from constants import (
+    ACCEPT_ENCODING,
+    ALL_RATINGS,
+    BASE_URL,
+    MAX_FETCH_ATTEMPTS,
+    MAX_SEARCH_TAGS,
+    RESPONSE_CACHE,
+    RESPONSE_CACHE_MAX_AGE,
+)
 from logger import logger
+from rate_controller import RateController
+from transfer_stats import counted_stream
 
 
-def fetch_image_infos(
-    http: urllib3.PoolManager,
-    results: Dict[str, str],
-    query: str,
-    rating: Optional[str] = None,
+class PostInfo(NamedTuple):
+    md5: str
+    url: str
+    file_size: Optional[int]
+    score: Optional[int]
+    width: Optional[int]
+    height: Optional[int]
+    rating: Optional[str]
+    tags: Optional[str]
+    created_at: Optional[int]
+    # Smaller variants of the image, left out if they are the original file
+    jpeg_url: Optional[str]
+    jpeg_width: Optional[int]
+    jpeg_height: Optional[int]
+    sample_url: Optional[str]
+    sample_width: Optional[int]
+    sample_height: Optional[int]
+
+
+# Number of posts on a page, the highest post id on it and the posts that
+# passed the filters
+PageResult = Tuple[int, int, List[PostInfo]]
+
+
+class CachedResponse(NamedTuple):
+    etag: Optional[str]
+    last_modified: Optional[str]
+    result: PageResult
+
+
+class ResponseCache:
+    """
+    On-disk cache of the ETag / Last-Modified validators sent by the server
+    for post pages. Besides the validators, an entry only keeps the post
+    count, highest id and md5 hashes of its page; the posts themselves are
+    read back with `load_posts`, which returns the known ones keyed by md5.
+
+    Entries are keyed by request URL without the incremental refresh (id)
+    filter, so a page keeps one entry that is replaced whenever its filter
+    moves. Validators only apply to the exact URL they were sent for, so a
+    refresh is answered from the cache only if the search had no new posts
+    since the previous one. Entries not used for `RESPONSE_CACHE_MAX_AGE`
+    are dropped on save.
+    """
+
+    VERSION = 1
+
+    def __init__(
+        self,
+        load_posts: Callable[[List[str]], Dict[str, PostInfo]],
+        path: str = RESPONSE_CACHE,
+    ) -> None:
+        self.path = path
+        self._load_posts = load_posts
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+
+        logger.debug("Loading response cache...")
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except Exception as e:
+            logger.warning(f"Failed to load response cache: {e}")
+            return
+
+        # Entries of an older format can't be reused
+        if cache.get("version") == self.VERSION:
+            self._entries = cache.get("entries", {})
+
+    def save(self) -> None:
+        logger.debug("Saving response cache...")
+        min_used_at = time.time() - RESPONSE_CACHE_MAX_AGE
+        with self._lock:
+            entries = {
+                key: entry
+                for key, entry in self._entries.items()
+                if entry.get("used_at", 0) >= min_used_at
+            }
+
+        try:
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump({"version": self.VERSION, "entries": entries}, f)
+        except Exception as e:
+            logger.warning(f"Failed to save response cache: {e}")
+
+    def get(self, url: str, max_image_size: Optional[int]) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(self._get_key(url))
+            if (
+                entry is None
+                or entry.get("url") != url
+                or entry.get("max_image_size") != max_image_size
+            ):
+                return None
+
+            entry["used_at"] = time.time()
+
+        posts_count, max_id, hashes = entry["page"]
+
+        # Posts of dropped searches are gone, so their pages have to be
+        # downloaded again
+        posts = self._load_posts(hashes)
+        if len(posts) != len(hashes):
+            return None
+
+        return CachedResponse(
+            entry.get("etag"),
+            entry.get("last_modified"),
+            (posts_count, max_id, [posts[md5] for md5 in hashes]),
+        )
+
+    def put(
+        self,
+        url: str,
+        max_image_size: Optional[int],
+        etag: Optional[str],
+        last_modified: Optional[str],
+        result: PageResult,
+    ) -> None:
+        posts_count, max_id, posts = result
+        entry = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "max_image_size": max_image_size,
+            "page": [posts_count, max_id, [post.md5 for post in posts]],
+            "used_at": time.time(),
+        }
+
+        with self._lock:
+            self._entries[self._get_key(url)] = entry
+
+    @staticmethod
+    def _get_key(url: str) -> str:
+        # Tags are quoted in the URL, so only the filter can contain "+id:>"
+        return url.split("+id:>", 1)[0]
+
+
+class SearchPlan(NamedTuple):
+    # Tags sent to the API, also used as the key for per-search state
+    tags: str
+    # Configured (query, rating) pairs this search covers
+    pairs: List[Tuple[str, str]]
+    max_pages: int
+
+
+class SearchResult(NamedTuple):
+    # Posts keyed by md5
+    posts: Dict[str, PostInfo]
+    # Highest post id seen, used for the next incremental refresh
+    max_id: int
+    # False if some page failed and the search should be retried early
+    complete: bool
+
+
+def get_rating_filter(ratings: List[str]) -> Optional[str]:
+    rating_set = set(ratings)
+    if rating_set >= ALL_RATINGS:
+        return None
+
+    if len(rating_set) == 1:
+        return f"rating:{next(iter(rating_set))}"
+
+    # Two of the three ratings are the same as excluding the third one
+    return f"-rating:{next(iter(ALL_RATINGS - rating_set))}"
+
+
+def _is_combinable_query(query: str) -> bool:
+    # Only a single plain tag can take part in an OR (~tag) search
+    return (
+        len(query.split()) == 1
+        and query[0] not in "-~"
+        and ":" not in query
+        and "*" not in query
+    )
+
+
+def _plan_rating_group(
+    queries: List[str],
+    ratings: List[str],
+    min_score: Optional[int],
+    max_pages: int,
+) -> List[SearchPlan]:
+    rating_filter = get_rating_filter(ratings)
+
+    # Leave room for the rating, score and incremental refresh (id) filters
+    filter_tags = 1 + (rating_filter is not None) + bool(min_score)
+    group_size = max(1, MAX_SEARCH_TAGS - filter_tags)
+
+    groups: List[List[str]] = []
+    open_group: Optional[List[str]] = None
+    for query in queries:
+        if group_size > 1 and _is_combinable_query(query):
+            if open_group is None or len(open_group) == group_size:
+                open_group = []
+                groups.append(open_group)
+
+            open_group.append(query)
+        else:
+            groups.append([query])
+
+    plans: List[SearchPlan] = []
+    for group in groups:
+        tags = [f"~{query}" for query in group] if len(group) > 1 else group[:1]
+        if rating_filter:
+            tags.append(rating_filter)
+
+        plans.append(
+            SearchPlan(
+                tags=" ".join(tags),
+                pairs=[(query, rating) for rating in ratings for query in group],
+                max_pages=max_pages * len(group) * len(ratings),
+            )
+        )
+
+    return plans
+
+
+def plan_searches(
+    queries: List[str],
+    ratings: List[str],
     min_score: Optional[int] = None,
     max_pages: int = 10,
-    per_page: int = 100,
-    max_image_size: Optional[int] = None,
-) -> None:
-    rating_filter = f"+rating:{rating}" if rating else ""
-
-    page = 1
-    while page <= max_pages:
-        url = (
-            f"{BASE_URL}?limit={per_page}&page={page}"
-            f"&tags={quote_plus(query)}{rating_filter}"
+    reusable_plans: Optional[List[SearchPlan]] = None,
+) -> List[SearchPlan]:
+    """
+    Rewrites the configured queries and ratings into the smallest set of tag
+    searches covering the same (query, rating) pairs. Ratings are folded into
+    a single rating filter and single tag queries are combined with the OR
+    (~tag) syntax, up to the API tag limit. A combined search gets the page
+    budget of all the searches it replaces.
+
+    Searches from `reusable_plans` (e.g. cached ones) are kept as long as all
+    their pairs are still wanted, so only the remaining pairs are re-planned.
+    """
+    unique_ratings = list(dict.fromkeys(ratings))
+    wanted_pairs = [
+        (query, rating) for rating in unique_ratings for query in dict.fromkeys(queries)
+    ]
+    remaining_pairs = set(wanted_pairs)
+
+    plans: List[SearchPlan] = []
+    for plan in reusable_plans or []:
+        if plan.pairs and remaining_pairs.issuperset(plan.pairs):
+            plans.append(plan)
+            remaining_pairs.difference_update(plan.pairs)
+
+    reused_count = len(plans)
+
+    # Queries still missing the same ratings can share a rating filter
+    query_ratings: Dict[str, List[str]] = {}
+    for query, rating in wanted_pairs:
+        if (query, rating) in remaining_pairs:
+            query_ratings.setdefault(query, []).append(rating)
+
+    rating_groups: Dict[Tuple[str, ...], List[str]] = {}
+    for query, missing_ratings in query_ratings.items():
+        rating_groups.setdefault(tuple(missing_ratings), []).append(query)
+
+    for group_ratings, group_queries in rating_groups.items():
+        plans.extend(
+            _plan_rating_group(group_queries, list(group_ratings), min_score, max_pages)
         )
 
-        if min_score:
-            url += f"+score:>={min_score}"
+    # Without planning every pair is a search of its own with up to
+    # `max_pages` requests
+    logger.info(
+        f"Planned {len(plans)} search(es) for {len(wanted_pairs)} query/rating "
+        f"pair(s), {reused_count} reused: {len(plans)} to "
+        f"{sum(plan.max_pages for plan in plans)} request(s) instead of "
+        f"{len(wanted_pairs)} to {len(wanted_pairs) * max_pages}"
+    )
 
-        try:
-            response: urllib3.HTTPResponse = http.request("GET", url, timeout=30)
+    return plans
 
-            if response.status != 200:
+
+_json_decoder = json.JSONDecoder()
+
+
+def _iter_json_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+    """
+    Incrementally decodes a top-level JSON array from a stream of byte
+    chunks, yielding each element as soon as it is complete.
+    """
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    started = False
+
+    for chunk in chunks:
+        buffer = buffer[pos:] + utf8_decoder.decode(chunk)
+        pos = 0
+
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\n\r,":
+                pos += 1
+
+            if pos == len(buffer):
                 break
 
-            posts = json.loads(response.data.decode("utf-8"))
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array")
+
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == "]":
+                return
 
-            if not posts:
+            try:
+                item, end = _json_decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The element is not complete yet, wait for more data
                 break
 
-            for post in posts:
-                img_url = post.get("file_url")
-                img_hash = post.get("md5")
+            # A number at the end of the buffer may go on in the next chunk.
+            # Complete elements are followed by at least the closing bracket
+            if end == len(buffer):
+                break
+
+            pos = end
+            yield item
+
+    raise ValueError("Truncated JSON array")
 
-                if not img_url or not img_hash or img_hash in results:
-                    continue
 
-                if max_image_size:
-                    img_size = post.get("file_size")
-                    if not img_size or img_size > max_image_size:
-                        continue
+def _get_variant(
+    post: Dict[str, Any], name: str, img_url: str
+) -> Tuple[Optional[str], Optional[int], Optional[int]]:
+    url = post.get(f"{name}_url")
+    if not url or url == img_url:
+        return None, None, None
 
-                results[img_hash] = img_url
+    return url, post.get(f"{name}_width"), post.get(f"{name}_height")
 
-            page += 1
 
+def _read_page(
+    response: urllib3.HTTPResponse, max_image_size: Optional[int]
+) -> PageResult:
+    # Posts are parsed one by one off the socket and only the fields we need
+    # are kept, so a full page is never held in memory at once
+    posts_count = 0
+    max_id = 0
+    posts: List[PostInfo] = []
+    for post in _iter_json_array(counted_stream(response, 65536)):
+        posts_count += 1
+
+        post_id = post.get("id")
+        if isinstance(post_id, int) and post_id > max_id:
+            max_id = post_id
+
+        img_url = post.get("file_url")
+        img_hash = post.get("md5")
+
+        if not img_url or not img_hash:
+            continue
+
+        img_size = post.get("file_size")
+        if max_image_size and (not img_size or img_size > max_image_size):
+            continue
+
+        posts.append(
+            PostInfo(
+                img_hash,
+                img_url,
+                img_size,
+                post.get("score"),
+                post.get("width"),
+                post.get("height"),
+                post.get("rating"),
+                post.get("tags"),
+                post.get("created_at"),
+                *_get_variant(post, "jpeg", img_url),
+                *_get_variant(post, "sample", img_url),
+            )
+        )
+
+    return posts_count, max_id, posts
+
+
+def fetch_image_infos(
+    http: urllib3.PoolManager,
+    tags: str,
+    min_score: Optional[int] = None,
+    page: int = 1,
+    per_page: int = 100,
+    max_image_size: Optional[int] = None,
+    min_id: Optional[int] = None,
+    response_cache: Optional[ResponseCache] = None,
+    api_url: str = BASE_URL,
+    rate_controller: Optional[RateController] = None,
+    stop_event: Optional[threading.Event] = None,
+) -> Optional[PageResult]:
+    """
+    Fetches a single page of posts, retrying throttled and failed requests.
+    Returns None if the page could not be fetched.
+    """
+    url = f"{api_url}?limit={per_page}&page={page}&tags={quote_plus(tags)}"
+
+    if min_score:
+        url += f"+score:>={min_score}"
+
+    if min_id:
+        url += f"+id:>{min_id}"
+
+    if rate_controller is None:
+        rate_controller = RateController(1)
+
+    headers = {"Accept-Encoding": ACCEPT_ENCODING}
+    cached = response_cache.get(url, max_image_size) if response_cache else None
+    if cached:
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+
+        if cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+
+    for _ in range(MAX_FETCH_ATTEMPTS):
+        if not rate_controller.acquire(stop_event):
+            return None
+
+        response: Optional[urllib3.HTTPResponse] = None
+        try:
+            response = http.request(
+                "GET", url, headers=headers, timeout=30, preload_content=False
+            )
+
+            if response.status == 304 and cached:
+                rate_controller.on_success()
+                logger.debug(f"Page not modified: {url}")
+                return cached.result
+
+            if response.status in (429, 503):
+                logger.warning(f"Throttled: {url} (status {response.status})")
+                rate_controller.on_throttled(response.headers.get("Retry-After"))
+                continue
+
+            if response.status != 200:
+                logger.error(f"Failed to fetch page: {url} (status {response.status})")
+
+                # Other client errors only concern this request, so they are
+                # neither retried nor slow down the others
+                if response.status < 500:
+                    return None
+
+                rate_controller.on_error()
+                continue
+
+            result = _read_page(response, max_image_size)
+            rate_controller.on_success()
+
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if response_cache and (etag or last_modified):
+                response_cache.put(url, max_image_size, etag, last_modified, result)
+
+            return result
         except Exception as e:
             logger.error(e, stack_info=True)
-            time.sleep(1)
-            break
+            if isinstance(e, urllib3.exceptions.HTTPError):
+                rate_controller.on_error()
         finally:
-            response.release_conn()
+            if response is not None:
+                # Whatever is left of the body is read first, otherwise the
+                # next request on the reused connection would get it as its
+                # response
+                response.drain_conn()
+                response.release_conn()
+
+            rate_controller.release()
+
+    logger.error(f"Giving up on page after {MAX_FETCH_ATTEMPTS} attempts: {url}")
+
+    return None
+
+
+def _count_separate_requests(
+    plan: SearchPlan, posts: Iterable[PostInfo], per_page: int
+) -> int:
+    """
+    Estimates how many requests a search per (query, rating) pair of `plan`
+    would have needed for the same posts.
+    """
+    single_query = len({query for query, _ in plan.pairs}) == 1
+    counts = {pair: 0 for pair in plan.pairs}
+    for post in posts:
+        tags = set((post.tags or "").split())
+        for query, rating in plan.pairs:
+            if post.rating == rating and (single_query or query in tags):
+                counts[(query, rating)] += 1
+
+    max_pages = max(1, plan.max_pages // len(plan.pairs)) if plan.pairs else 1
+    return sum(
+        min(max_pages, max(1, math.ceil(count / per_page))) for count in counts.values()
+    )
 
 
 def fetch_and_cache_all_image_infos(
-    queries: List[str],
-    ratings: List[str],
+    plans: List[SearchPlan],
     min_score: Optional[int] = None,
-    max_pages: int = 10,
     per_page: int = 100,
     max_image_size: Optional[int] = None,
-) -> Dict[str, str]:
-    http = urllib3.PoolManager()
-    results: Dict[str, str] = {}
-    ratings_set = set(ratings)
-
-    for rating in ratings_set:
-        for query in queries:
-            fetch_image_infos(
-                http,
-                results,
-                query,
-                rating,
-                min_score,
-                max_pages,
-                per_page,
-                max_image_size,
-            )
+    workers: int = 8,
+    max_ids: Optional[Dict[str, int]] = None,
+    on_page: Optional[Callable[[SearchPlan, List[PostInfo]], None]] = None,
+    stop_event: Optional[threading.Event] = None,
+    api_url: str = BASE_URL,
+    rate_controller: Optional[RateController] = None,
+    load_posts: Optional[Callable[[List[str]], Dict[str, PostInfo]]] = None,
+) -> Dict[str, SearchResult]:
+    """
+    Fetches image infos for every planned search. `max_ids` holds the highest
+    post id already seen per search tags; only newer posts are fetched for
+    those searches. Returns the results keyed by search tags.
+
+    `on_page` is called with the plan and infos of every page as soon as it
+    arrives, in completion order. Once `stop_event` is set no new pages are requested.
+
+    Unchanged pages are only answered from the response cache if
+    `load_posts` is given to read their posts back, see `ResponseCache`.
+    """
+    known_max_ids = max_ids or {}
+    min_ids = [known_max_ids.get(plan.tags) for plan in plans]
+
+    http = urllib3.PoolManager(maxsize=workers)
+
+    if rate_controller is None:
+        rate_controller = RateController(workers)
+
+    response_cache: Optional[ResponseCache] = None
+    if load_posts:
+        response_cache = ResponseCache(load_posts)
+        response_cache.load()
+
+    # Page results keyed by (plan index, page); None marks a failed request
+    pages: Dict[Tuple[int, int], Optional[PageResult]] = {}
+
+    # First page that came back empty or failed, or the one after a short
+    # page, past which a search is done
+    last_page = [plan.max_pages + 1 for plan in plans]
+    next_page = [1] * len(plans)
+
+    # Pages are only requested ahead once earlier ones came back full, so a
+    # small search doesn't send requests for pages that don't exist. Every
+    # full page doubles how far ahead a search may go
+    max_ahead_page = [1] * len(plans)
+
+    failed = [False] * len(plans)
+
+    in_flight: Dict["Future[Optional[PageResult]]", Tuple[int, int]] = {}
+
+    cursor = 0
+
+    def next_job() -> Optional[Tuple[int, int]]:
+        nonlocal cursor
+
+        # Round-robin over searches so every search makes progress early on
+        for _ in range(len(plans)):
+            plan_index = cursor
+            cursor = (cursor + 1) % len(plans)
+
+            page = next_page[plan_index]
+            if page < last_page[plan_index] and page <= max_ahead_page[plan_index]:
+                next_page[plan_index] += 1
+                return plan_index, page
+
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def submit_jobs() -> None:
+            while len(in_flight) < workers:
+                if stop_event and stop_event.is_set():
+                    return
+
+                job = next_job()
+                if job is None:
+                    return
+
+                plan_index, page = job
+                future = executor.submit(
+                    fetch_image_infos,
+                    http,
+                    plans[plan_index].tags,
+                    min_score,
+                    page,
+                    per_page,
+                    max_image_size,
+                    min_ids[plan_index],
+                    response_cache,
+                    api_url,
+                    rate_controller,
+                    stop_event,
+                )
+                in_flight[future] = job
+
+        submit_jobs()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                plan_index, page = in_flight.pop(future)
+                page_result = future.result()
+                pages[(plan_index, page)] = page_result
+
+                if not page_result or not page_result[0]:
+                    if page < last_page[plan_index]:
+                        last_page[plan_index] = page
+                        failed[plan_index] = page_result is None
+                    continue
+
+                if on_page and page < last_page[plan_index]:
+                    on_page(plans[plan_index], page_result[2])
+
+                if page_result[0] < per_page:
+                    last_page[plan_index] = min(last_page[plan_index], page + 1)
+                else:
+                    max_ahead_page[plan_index] = max(
+                        max_ahead_page[plan_index], page * 2
+                    )
+
+            submit_jobs()
+
+    if response_cache:
+        response_cache.save()
+
+    results: Dict[str, SearchResult] = {}
+    separate_requests = 0
+    for plan_index, plan in enumerate(plans):
+        posts: Dict[str, PostInfo] = {}
+        max_id = known_max_ids.get(plan.tags, 0)
+
+        # A stopped fetch leaves the pages past the last requested one unseen
+        requested_pages = min(last_page[plan_index], next_page[plan_index])
+        if requested_pages < last_page[plan_index]:
+            failed[plan_index] = True
+
+        for page in range(1, requested_pages):
+            page_result = pages[(plan_index, page)]
+            if page_result is None:
+                continue
+
+            _, page_max_id, page_posts = page_result
+
+            # Older posts past a failed page were never seen, so keep the
+            # previous mark to pick them up again on the next refresh
+            if not failed[plan_index] and page_max_id > max_id:
+                max_id = page_max_id
+
+            for post in page_posts:
+                posts.setdefault(post.md5, post)
+
+        results[plan.tags] = SearchResult(posts, max_id, not failed[plan_index])
+        separate_requests += _count_separate_requests(plan, posts.values(), per_page)
+
+    logger.info(
+        f"Fetched {sum(1 for v in pages.values() if v is not None)} page(s) "
+        f"for {len(plans)} search(es) in {len(pages)} request(s), a search per "
+        f"query and rating would have needed at least {separate_requests}"
+    )
 
     return results
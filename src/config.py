@@ -2,9 +2,9 @@ import json
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Union
 
-from constants import CONFIG_PATH
+from constants import BASE_URL, CONFIG_PATH
 from logger import logger
-from utils import parse_duration
+from utils import parse_duration, parse_resolution
 
 
 class Hotkeys:
@@ -105,6 +105,18 @@ class Config:
         min_score: Optional[int] = None,
         max_image_size: Optional[int] = 20971520,
         cache_refresh_interval: Optional[str] = "7d",
+        fetch_workers: int = 8,
+        download_workers: int = 4,
+        download_buffer_size: int = 262144,
+        api_url: str = BASE_URL,
+        score_weight: float = 0.0,
+        recency_half_life: Optional[str] = None,
+        seen_history_size: int = 10000,
+        seen_history_fp_rate: float = 0.01,
+        adaptive_prefetch: bool = False,
+        target_resolution: Optional[str] = "auto",
+        resize_images: bool = False,
+        resize_quality: int = 90,
         **kwargs: Any,
     ) -> None:
         if kwargs:
@@ -176,6 +188,64 @@ class Config:
         )
         self.cache_refresh_interval_str = cache_refresh_interval
 
+        if fetch_workers < 1:
+            raise ValueError("fetch_workers must be >= 1")
+
+        self.fetch_workers = fetch_workers
+
+        if download_workers < 1:
+            raise ValueError("download_workers must be >= 1")
+
+        self.download_workers = download_workers
+
+        if download_buffer_size < 4096:
+            raise ValueError("download_buffer_size must be >= 4096")
+
+        self.download_buffer_size = download_buffer_size
+
+        if not api_url.startswith(("http://", "https://")):
+            raise ValueError("api_url must be an http(s) URL")
+
+        self.api_url = api_url
+
+        if score_weight < 0:
+            raise ValueError("score_weight must be >= 0")
+
+        self.score_weight = score_weight
+
+        self.recency_half_life = (
+            parse_duration(recency_half_life) if recency_half_life else None
+        )
+        if self.recency_half_life is not None and not self.recency_half_life:
+            raise ValueError("recency_half_life must be > 0 if provided")
+
+        self.recency_half_life_str = recency_half_life
+
+        if seen_history_size < 0:
+            raise ValueError("seen_history_size must be >= 0")
+
+        self.seen_history_size = seen_history_size
+
+        if not (0.0 < seen_history_fp_rate < 1.0):
+            raise ValueError("seen_history_fp_rate must be between 0 and 1")
+
+        self.seen_history_fp_rate = seen_history_fp_rate
+        self.adaptive_prefetch = adaptive_prefetch
+
+        # "auto" is resolved to the screen resolution when the changer starts
+        self.target_resolution = (
+            parse_resolution(target_resolution)
+            if target_resolution and target_resolution != "auto"
+            else None
+        )
+        self.target_resolution_str = target_resolution
+        self.resize_images = resize_images
+
+        if not (1 <= resize_quality <= 95):
+            raise ValueError("resize_quality must be between 1 and 95")
+
+        self.resize_quality = resize_quality
+
     def _validate_ratings(self, ratings: List[str]) -> List[str]:
         allowed = {"s", "q", "e"}
         if not all(r in allowed for r in ratings):
@@ -202,6 +272,18 @@ class Config:
             "min_score": self.min_score,
             "max_image_size": self.max_image_size,
             "cache_refresh_interval": self.cache_refresh_interval_str,
+            "fetch_workers": self.fetch_workers,
+            "download_workers": self.download_workers,
+            "download_buffer_size": self.download_buffer_size,
+            "api_url": self.api_url,
+            "score_weight": self.score_weight,
+            "recency_half_life": self.recency_half_life_str,
+            "seen_history_size": self.seen_history_size,
+            "seen_history_fp_rate": self.seen_history_fp_rate,
+            "adaptive_prefetch": self.adaptive_prefetch,
+            "target_resolution": self.target_resolution_str,
+            "resize_images": self.resize_images,
+            "resize_quality": self.resize_quality,
         }
 
     @staticmethod
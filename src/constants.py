@@ -1,6 +1,25 @@
 CONFIG_PATH = "./config.json"
 IMAGE_INFOS_CACHE = "./cache.json"
+IMAGE_INFOS_DB = "./cache.db"
+RESPONSE_CACHE = "./response_cache.json"
+RESPONSE_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+SEEN_FILTER = "./seen_filter.bin"
+STATE_SNAPSHOT = "./state.json"
+STATE_SNAPSHOT_VERSION = 1
+SNAPSHOT_INTERVAL = 60
 BASE_URL = "https://konachan.com/post.json"
+ALL_RATINGS = frozenset(["s", "q", "e"])
+# Tag limit of a single Konachan search, filters (rating:, score:, id:) included
+MAX_SEARCH_TAGS = 6
+MAX_FETCH_ATTEMPTS = 5
+MIN_REFRESH_DELAY = 300
+# Weight factor of already seen images, so weighted picking takes them last
+SEEN_IMAGE_WEIGHT_FACTOR = 1e-6
+ACCEPT_ENCODING = "gzip, deflate"
+# Subfolder of the wallpaper folder for unfinished downloads
+PARTIAL_DOWNLOADS_FOLDER = ".partial"
+PARTIAL_DOWNLOAD_MAX_AGE = 7 * 24 * 60 * 60
+
 SINGLETON_LABEL = "konachan-wallpaper-changer"
 
 LOG_FILE_NAME = "app.log"
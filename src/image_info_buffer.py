@@ -0,0 +1,128 @@
+import hashlib
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from utils import split_url
+
+DIGEST_SIZE = 16
+
+
+class ImageInfoBuffer:
+    """
+    Growable ring buffer of (md5, url) image infos. Digests are kept as raw
+    bytes in one contiguous buffer and URLs as an interned prefix id plus a
+    suffix, with the md5 left out of the suffix when the URL contains it.
+    """
+
+    def __init__(self, items: Iterable[Tuple[str, str]] = ()) -> None:
+        self._prefixes: List[str] = []
+        self._prefix_ids: Dict[str, int] = {}
+
+        self._digests = bytearray()
+        self._url_prefixes = array("I")
+        self._url_suffixes: List[Optional[str]] = []
+        self._has_md5_in_url = bytearray()
+
+        self.capacity = 0
+        self.start = 0
+        self.count = 0
+
+        self.extend(items)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> Tuple[str, str]:
+        if not 0 <= index < self.count:
+            raise IndexError("Buffer index out of range")
+
+        slot = (self.start + index) % self.capacity
+        digest = self._digests[slot * DIGEST_SIZE : (slot + 1) * DIGEST_SIZE]
+        image_hash = digest.hex()
+
+        suffix = self._url_suffixes[slot] or ""
+        if self._has_md5_in_url[slot]:
+            suffix = image_hash + suffix
+
+        return image_hash, self._prefixes[self._url_prefixes[slot]] + suffix
+
+    def get_fingerprint(self) -> str:
+        """
+        Hash of the stored digests in order, to tell whether a buffer built
+        later holds the same items.
+        """
+        start = self.start * DIGEST_SIZE
+        digests = self._digests[start:] + self._digests[:start]
+        return hashlib.md5(digests[: self.count * DIGEST_SIZE]).hexdigest()
+
+    def append(self, item: Tuple[str, str]) -> None:
+        if self.count == self.capacity:
+            self._grow(max(16, self.capacity * 2))
+
+        self._store((self.start + self.count) % self.capacity, item)
+        self.count += 1
+
+    def extend(self, items: Iterable[Tuple[str, str]]) -> None:
+        for item in items:
+            self.append(item)
+
+    def popleft(self) -> Tuple[str, str]:
+        if self.count == 0:
+            raise IndexError("Buffer is empty")
+
+        item = self[0]
+        self._url_suffixes[self.start] = None
+        self.start = (self.start + 1) % self.capacity
+        self.count -= 1
+
+        return item
+
+    def _store(self, slot: int, item: Tuple[str, str]) -> None:
+        image_hash, image_url = item
+        prefix, suffix = split_url(image_url)
+
+        prefix_id = self._prefix_ids.get(prefix)
+        if prefix_id is None:
+            prefix_id = len(self._prefixes)
+            self._prefixes.append(prefix)
+            self._prefix_ids[prefix] = prefix_id
+
+        # Konachan file URLs start their path with the md5 of the image
+        has_md5_in_url = suffix.startswith(image_hash)
+        if has_md5_in_url:
+            suffix = suffix[len(image_hash) :]
+
+        self._digests[slot * DIGEST_SIZE : (slot + 1) * DIGEST_SIZE] = bytes.fromhex(
+            image_hash
+        )
+        self._url_prefixes[slot] = prefix_id
+        self._url_suffixes[slot] = suffix or None
+        self._has_md5_in_url[slot] = has_md5_in_url
+
+    def _grow(self, capacity: int) -> None:
+        # Only called when full, so unwrapping the ring puts the new free
+        # slots after the last item
+        start = self.start
+        extra = capacity - self.capacity
+
+        self._digests = (
+            self._digests[start * DIGEST_SIZE :]
+            + self._digests[: start * DIGEST_SIZE]
+            + bytearray(extra * DIGEST_SIZE)
+        )
+        self._url_prefixes = (
+            self._url_prefixes[start:]
+            + self._url_prefixes[:start]
+            + array("I", [0]) * extra
+        )
+        self._url_suffixes = (
+            self._url_suffixes[start:] + self._url_suffixes[:start] + [None] * extra
+        )
+        self._has_md5_in_url = (
+            self._has_md5_in_url[start:]
+            + self._has_md5_in_url[:start]
+            + bytearray(extra)
+        )
+
+        self.capacity = capacity
+        self.start = 0
@@ -0,0 +1,47 @@
+import os
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed for resizing
+    Image = None
+
+
+def is_resizing_available() -> bool:
+    return Image is not None
+
+
+def resize_image(
+    path: str, temp_path: str, width: int, height: int, quality: int
+) -> str:
+    """
+    Scales the image at `path` down to the smallest size that still covers
+    `width` x `height` and stores it as a JPEG in place of the original.
+    Returns the path of the stored image, which is `path` if the image isn't
+    larger than that. Runs in a worker process.
+    """
+    assert Image is not None
+
+    with Image.open(path) as image:
+        scale = max(width / image.width, height / image.height)
+        if scale >= 1:
+            return path
+
+        size = (
+            max(1, round(image.width * scale)),
+            max(1, round(image.height * scale)),
+        )
+
+        # JPEG files are decoded at a fraction of their size right away
+        image.draft("RGB", size)
+        resized = image.convert("RGB").resize(
+            size, Image.Resampling.LANCZOS, reducing_gap=3.0
+        )
+
+    resized.save(temp_path, "JPEG", quality=quality, optimize=True)
+
+    output_path = f"{os.path.splitext(path)[0]}.jpg"
+    os.replace(temp_path, output_path)
+    if output_path != path:
+        os.remove(path)
+
+    return output_path
@@ -1,4 +1,5 @@
 from datetime import datetime
+import multiprocessing
 import sys
 import threading
 import time
@@ -10,11 +11,19 @@ from config import load_config
 from constants import SINGLETON_LABEL
 from logger import logger
 from toasts import ToastManager
-from utils import set_dpi_awareness, show_error, windows_console_exit_handler
+from utils import (
+    get_screen_resolution,
+    set_dpi_awareness,
+    show_error,
+    windows_console_exit_handler,
+)
 from wallpaper_changer import WallpaperChanger
 from singleton import SingleInstance, SingleInstanceException
 
 if __name__ == "__main__":
+    # Image resizing workers start this script again in frozen builds
+    multiprocessing.freeze_support()
+
     listener: Optional[keyboard.GlobalHotKeys] = None
 
     try:
@@ -25,6 +34,11 @@ if __name__ == "__main__":
             if config.default_image:
                 config.default_image = config.default_image.resolve()
 
+            # Needs its own Tk instance on Linux, which can't run next to the
+            # toast thread's one, so it is detected before that starts
+            if config.target_resolution_str == "auto":
+                get_screen_resolution()
+
             if config.show_toasts:
                 started_event = threading.Event()
                 threading.Thread(
@@ -0,0 +1,384 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, cast
+
+from api import PostInfo, SearchPlan
+from constants import IMAGE_INFOS_CACHE, IMAGE_INFOS_DB
+from logger import logger
+from utils import load_image_infos_cache, split_url
+
+# Bumped on every schema change, stored as PRAGMA user_version
+SCHEMA_VERSION = 1
+
+# Posts are keyed by their raw 16-byte md5 digest and store the URL as a
+# shared prefix and the post specific suffix
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS searches (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    tags TEXT NOT NULL,
+    pairs TEXT NOT NULL,
+    max_pages INTEGER NOT NULL,
+    max_id INTEGER NOT NULL DEFAULT 0,
+    fetched_at INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS url_prefixes (
+    id INTEGER PRIMARY KEY,
+    prefix TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS posts (
+    md5 BLOB PRIMARY KEY,
+    url_prefix INTEGER NOT NULL REFERENCES url_prefixes (id),
+    url_suffix TEXT NOT NULL,
+    file_size INTEGER,
+    score INTEGER,
+    width INTEGER,
+    height INTEGER,
+    rating TEXT,
+    tags TEXT,
+    created_at INTEGER,
+    fetched_at INTEGER NOT NULL,
+    jpeg_url_prefix INTEGER REFERENCES url_prefixes (id),
+    jpeg_url_suffix TEXT,
+    jpeg_width INTEGER,
+    jpeg_height INTEGER,
+    sample_url_prefix INTEGER REFERENCES url_prefixes (id),
+    sample_url_suffix TEXT,
+    sample_width INTEGER,
+    sample_height INTEGER
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS search_posts (
+    search_id INTEGER NOT NULL REFERENCES searches (id),
+    md5 BLOB NOT NULL,
+    PRIMARY KEY (search_id, md5)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS posts_score ON posts (score);
+CREATE INDEX IF NOT EXISTS posts_file_size ON posts (file_size);
+CREATE INDEX IF NOT EXISTS posts_rating ON posts (rating);
+CREATE INDEX IF NOT EXISTS search_posts_md5 ON search_posts (md5);
+"""
+
+# Key prefix of the search holding the posts of the cache.json of the first
+# release, followed by the hash of the queries and ratings it was fetched for
+LEGACY_SEARCH_PREFIX = "cache.json:"
+
+
+class CachedImageInfo(NamedTuple):
+    url: str
+    score: Optional[int]
+    created_at: Optional[int]
+
+
+class ImageVariant(NamedTuple):
+    url: str
+    width: Optional[int]
+    height: Optional[int]
+    is_original: bool
+
+
+class SearchRecord(NamedTuple):
+    plan: SearchPlan
+    max_id: int
+    fetched_at: int
+
+
+def _load_plan(tags: str, pairs: str, max_pages: int) -> SearchPlan:
+    return SearchPlan(
+        tags, [(query, rating) for query, rating in json.loads(pairs)], max_pages
+    )
+
+
+class MetadataStore:
+    """
+    SQLite store of post metadata, partitioned by the planned search (cache
+    partition) each post was fetched for.
+    """
+
+    # Lets SQLite read the database through a memory map instead of copying
+    # pages into its own cache
+    MMAP_SIZE = 256 * 1024 * 1024
+
+    def __init__(self, path: str = IMAGE_INFOS_DB) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._url_prefixes: Dict[str, int] = {}
+
+        # Writes come from the image info fetch thread
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(f"PRAGMA mmap_size = {self.MMAP_SIZE}")
+
+        # Changes are appended to a write-ahead log, so a write only costs the
+        # changed pages and a crash loses at most the last transaction
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+
+        self._create_schema()
+        self._url_prefixes = dict(
+            self._connection.execute("SELECT prefix, id FROM url_prefixes")
+        )
+
+        self._migrate_json_cache()
+
+    def close(self) -> None:
+        self.checkpoint()
+
+        with self._lock:
+            self._connection.close()
+
+    def checkpoint(self) -> None:
+        """
+        Copies the write-ahead log into the database and truncates it.
+        """
+        with self._lock:
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def get_searches(self) -> Dict[str, SearchRecord]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key, tags, pairs, max_pages, max_id, fetched_at FROM searches"
+            ).fetchall()
+
+        return {
+            key: SearchRecord(_load_plan(tags, pairs, max_pages), max_id, fetched_at)
+            for key, tags, pairs, max_pages, max_id, fetched_at in rows
+        }
+
+    def get_image_infos(self, search_keys: Iterable[str]) -> Dict[str, CachedImageInfo]:
+        keys = list(search_keys)
+        if not keys:
+            return {}
+
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT DISTINCT posts.md5, url_prefixes.prefix, posts.url_suffix, "
+                "posts.score, posts.created_at FROM searches "
+                "JOIN search_posts ON search_posts.search_id = searches.id "
+                "JOIN posts ON posts.md5 = search_posts.md5 "
+                "JOIN url_prefixes ON url_prefixes.id = posts.url_prefix "
+                f"WHERE searches.key IN ({', '.join('?' * len(keys))}) "
+                "ORDER BY posts.md5",
+                keys,
+            ).fetchall()
+
+        return {
+            md5.hex(): CachedImageInfo(prefix + suffix, score, created_at)
+            for md5, prefix, suffix, score, created_at in rows
+        }
+
+    def get_image_variants(self, image_hash: str) -> List[ImageVariant]:
+        """
+        Returns the original file of a post and its smaller variants, or an
+        empty list for an unknown post.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT original.prefix, posts.url_suffix, posts.width, "
+                "posts.height, jpeg.prefix, posts.jpeg_url_suffix, "
+                "posts.jpeg_width, posts.jpeg_height, sample.prefix, "
+                "posts.sample_url_suffix, posts.sample_width, posts.sample_height "
+                "FROM posts "
+                "JOIN url_prefixes AS original ON original.id = posts.url_prefix "
+                "LEFT JOIN url_prefixes AS jpeg ON jpeg.id = posts.jpeg_url_prefix "
+                "LEFT JOIN url_prefixes AS sample "
+                "ON sample.id = posts.sample_url_prefix "
+                "WHERE posts.md5 = ?",
+                (bytes.fromhex(image_hash),),
+            ).fetchone()
+
+        if row is None:
+            return []
+
+        variants = [ImageVariant(row[0] + row[1], row[2], row[3], True)]
+        for prefix, suffix, width, height in (row[4:8], row[8:12]):
+            if prefix is not None:
+                variants.append(ImageVariant(prefix + suffix, width, height, False))
+
+        return variants
+
+    def get_posts(self, image_hashes: List[str]) -> Dict[str, PostInfo]:
+        """
+        Returns the stored posts of the given md5 hashes, leaving out unknown
+        ones.
+        """
+        if not image_hashes:
+            return {}
+
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT posts.md5, original.prefix || posts.url_suffix, "
+                "posts.file_size, posts.score, posts.width, posts.height, "
+                "posts.rating, posts.tags, posts.created_at, "
+                "jpeg.prefix || posts.jpeg_url_suffix, posts.jpeg_width, "
+                "posts.jpeg_height, sample.prefix || posts.sample_url_suffix, "
+                "posts.sample_width, posts.sample_height FROM posts "
+                "JOIN url_prefixes AS original ON original.id = posts.url_prefix "
+                "LEFT JOIN url_prefixes AS jpeg ON jpeg.id = posts.jpeg_url_prefix "
+                "LEFT JOIN url_prefixes AS sample "
+                "ON sample.id = posts.sample_url_prefix "
+                f"WHERE posts.md5 IN ({', '.join('?' * len(image_hashes))})",
+                [bytes.fromhex(image_hash) for image_hash in image_hashes],
+            ).fetchall()
+
+        return {md5.hex(): PostInfo(md5.hex(), *row) for md5, *row in rows}
+
+    def save_search(
+        self, key: str, plan: SearchPlan, max_id: int, fetched_at: int
+    ) -> None:
+        """
+        Stores the refresh state of a search.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO searches (key, tags, pairs, max_pages, max_id, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET pairs = excluded.pairs, "
+                "max_pages = excluded.max_pages, max_id = excluded.max_id, "
+                "fetched_at = excluded.fetched_at",
+                (
+                    key,
+                    plan.tags,
+                    json.dumps(plan.pairs),
+                    plan.max_pages,
+                    max_id,
+                    fetched_at,
+                ),
+            )
+
+    def add_posts(self, key: str, plan: SearchPlan, posts: Iterable[PostInfo]) -> None:
+        """
+        Stores posts of a search in one transaction. A search that isn't stored
+        yet is added without refresh state, so it is fetched again until
+        `save_search` completes it.
+        """
+        fetched_at = int(time.time())
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO searches (key, tags, pairs, max_pages) "
+                "VALUES (?, ?, ?, ?) ON CONFLICT (key) DO NOTHING",
+                (key, plan.tags, json.dumps(plan.pairs), plan.max_pages),
+            )
+            search_id = self._connection.execute(
+                "SELECT id FROM searches WHERE key = ?", (key,)
+            ).fetchone()[0]
+
+            # Prefixes are only remembered once the transaction is committed
+            new_prefixes: Dict[str, int] = {}
+            post_rows = []
+            for post in posts:
+                post_rows.append(
+                    (
+                        bytes.fromhex(post.md5),
+                        *self._split_url(post.url, new_prefixes),
+                        post.file_size,
+                        post.score,
+                        post.width,
+                        post.height,
+                        post.rating,
+                        post.tags,
+                        post.created_at,
+                        fetched_at,
+                        *self._split_url(post.jpeg_url, new_prefixes),
+                        post.jpeg_width,
+                        post.jpeg_height,
+                        *self._split_url(post.sample_url, new_prefixes),
+                        post.sample_width,
+                        post.sample_height,
+                    )
+                )
+
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO posts (md5, url_prefix, url_suffix, "
+                "file_size, score, width, height, rating, tags, created_at, "
+                "fetched_at, jpeg_url_prefix, jpeg_url_suffix, jpeg_width, "
+                "jpeg_height, sample_url_prefix, sample_url_suffix, sample_width, "
+                "sample_height) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                post_rows,
+            )
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO search_posts (search_id, md5) VALUES (?, ?)",
+                [(search_id, row[0]) for row in post_rows],
+            )
+
+        self._url_prefixes.update(new_prefixes)
+
+    def delete_searches_except(self, keys: Iterable[str]) -> None:
+        kept_keys = list(keys)
+        placeholders = ", ".join("?" * len(kept_keys))
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"DELETE FROM searches WHERE key NOT IN ({placeholders})", kept_keys
+            )
+            self._connection.execute(
+                "DELETE FROM search_posts "
+                "WHERE search_id NOT IN (SELECT id FROM searches)"
+            )
+            self._connection.execute(
+                "DELETE FROM posts WHERE md5 NOT IN (SELECT md5 FROM search_posts)"
+            )
+
+    def _split_url(
+        self, url: Optional[str], new_prefixes: Dict[str, int]
+    ) -> Tuple[Optional[int], Optional[str]]:
+        if url is None:
+            return None, None
+
+        prefix, suffix = split_url(url)
+        return self._get_url_prefix_id(prefix, new_prefixes), suffix
+
+    def _get_url_prefix_id(self, prefix: str, new_prefixes: Dict[str, int]) -> int:
+        prefix_id = self._url_prefixes.get(prefix) or new_prefixes.get(prefix)
+        if prefix_id is None:
+            cursor = self._connection.execute(
+                "INSERT INTO url_prefixes (prefix) VALUES (?)", (prefix,)
+            )
+            prefix_id = cast(int, cursor.lastrowid)
+            new_prefixes[prefix] = prefix_id
+
+        return prefix_id
+
+    def _create_schema(self) -> None:
+        self._connection.executescript(SCHEMA)
+        self._connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _migrate_json_cache(self) -> None:
+        if not os.path.exists(IMAGE_INFOS_CACHE):
+            return
+
+        logger.info(f"Migrating {IMAGE_INFOS_CACHE} to {self.path}...")
+
+        try:
+            cache = load_image_infos_cache()
+        except Exception as e:
+            logger.warning(f"Failed to load {IMAGE_INFOS_CACHE}: {e}")
+            return
+
+        # The first release stored the posts of all searches together, keyed
+        # by a hash of the queries and ratings
+        if isinstance(cache.get("data"), dict):
+            key = get_legacy_search_key(cache.get("hash", ""))
+            plan = SearchPlan("", [], 0)
+            self.save_search(key, plan, 0, cache.get("timestamp") or 0)
+            self.add_posts(
+                key,
+                plan,
+                (
+                    PostInfo(md5, url, *[None] * 13)
+                    for md5, url in cache["data"].items()
+                ),
+            )
+
+        os.remove(IMAGE_INFOS_CACHE)
+
+
+def get_legacy_search_key(cache_hash: str) -> str:
+    return f"{LEGACY_SEARCH_PREFIX}{cache_hash}"
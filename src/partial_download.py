@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Optional, Union
+
+import urllib3
+
+from logger import logger
+
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+VALIDATOR_SUFFIX = ".validator"
+HASH_READ_SIZE = 1024 * 1024
+# Written bytes after which the resume offset is stored again
+CHECKPOINT_SIZE = 4 * 1024 * 1024
+
+
+class PartialDownload:
+    """
+    File downloaded into a staging folder, kept with the validator (strong
+    ETag or Last-Modified) of its response when the download breaks off, so
+    it can continue with a Range request instead of starting over. Written
+    bytes are hashed as they come in, so the file is checked without reading
+    it again.
+
+    The file is preallocated to its full size, so its size doesn't tell how
+    much of it was written. The resume offset is stored with the validator
+    instead, when the download breaks off and every `CHECKPOINT_SIZE` bytes
+    in between, so a crash only loses the bytes since the last checkpoint.
+    """
+
+    def __init__(self, folder: Path, name: str) -> None:
+        self.path = folder / name
+        self._validator_path = folder / f"{name}{VALIDATOR_SUFFIX}"
+
+        self._file: Optional[BinaryIO] = None
+        self._md5 = hashlib.md5()
+        self._validator: Optional[str] = None
+        self._written = 0
+        self._checkpoint = 0
+
+    def __enter__(self) -> "PartialDownload":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        if self._file:
+            # Drops the preallocated space of a download that broke off
+            self._file.truncate()
+            self._file.close()
+            self._file = None
+
+            if self._validator:
+                self._save_state(self._written)
+
+    @property
+    def offset(self) -> int:
+        state = self._load_state()
+        if not state:
+            return 0
+
+        try:
+            return min(state["offset"], self.path.stat().st_size)
+        except FileNotFoundError:
+            return 0
+
+    def get_request_headers(self, accept_encoding: str) -> Dict[str, str]:
+        offset = self.offset
+        state = self._load_state()
+        if not offset or not state:
+            return {"Accept-Encoding": accept_encoding}
+
+        # Byte ranges of an encoded body don't match the decoded bytes on
+        # disk. If-Range makes the server send the whole file if it changed
+        return {
+            "Accept-Encoding": "identity",
+            "Range": f"bytes={offset}-",
+            "If-Range": state["validator"],
+        }
+
+    def open(self, response: urllib3.HTTPResponse) -> "PartialDownload":
+        """
+        Opens the staging file for the body of `response`, continuing the
+        partial download if the server sent the rest of it and starting over
+        otherwise. The file is preallocated when its size is known.
+        """
+        self._md5 = hashlib.md5()
+        self._validator = None
+        if response.status == 206:
+            match = CONTENT_RANGE_PATTERN.fullmatch(
+                response.headers.get("Content-Range", "")
+            )
+            offset = self.offset
+            if not match or int(match.group(1)) != offset:
+                # Resuming the same file would get the same answer again
+                self.remove()
+                raise ValueError("Server sent an unexpected range")
+
+            logger.debug(f"Resuming download at byte {offset}")
+            state = self._load_state()
+            assert state is not None
+            self._validator = state["validator"]
+            self._file = open(self.path, "r+b")
+
+            # Only the bytes of an earlier run have to be read back
+            while self._file.tell() < offset:
+                chunk = self._file.read(min(HASH_READ_SIZE, offset - self._file.tell()))
+                self._md5.update(chunk)
+
+            self._written = self._checkpoint = offset
+            self._save_state(offset)
+
+            if match.group(3) != "*":
+                self._preallocate(offset, int(match.group(3)) - offset)
+
+            return self
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._validator = self._get_validator(response)
+        self._written = self._checkpoint = 0
+        if self._validator:
+            self._save_state(0)
+        else:
+            self._validator_path.unlink(missing_ok=True)
+
+        self._file = open(self.path, "wb")
+
+        # Content-Length of an encoded body isn't the size of the file
+        content_length = response.headers.get("Content-Length")
+        if content_length and not self._is_encoded(response):
+            self._preallocate(0, int(content_length))
+
+        return self
+
+    def write(self, chunk: Union[bytes, memoryview]) -> None:
+        assert self._file is not None
+        self._file.write(chunk)
+        self._md5.update(chunk)
+        self._written += len(chunk)
+
+        if self._validator and self._written - self._checkpoint >= CHECKPOINT_SIZE:
+            # The bytes have to reach the file before the offset covers them
+            self._file.flush()
+            self._save_state(self._written)
+            self._checkpoint = self._written
+
+    def hexdigest(self) -> str:
+        return self._md5.hexdigest()
+
+    def complete(self, destination: str, md5: Optional[str]) -> bool:
+        """
+        Moves the finished download to `destination` if its digest matches
+        `md5`. A mismatching file is removed, as resuming it can't fix it.
+        """
+        if md5 and self.hexdigest() != md5.lower():
+            logger.error(
+                f"Downloaded file {self.path} doesn't match its md5 "
+                f"({self.hexdigest()} != {md5})"
+            )
+            self.remove()
+            return False
+
+        # Renamed within the same folder tree, so the file appears at once
+        os.replace(self.path, destination)
+        self._validator_path.unlink(missing_ok=True)
+        return True
+
+    def discard(self) -> None:
+        """
+        Removes the staging file unless it can be resumed.
+        """
+        if self.offset:
+            logger.debug(f"Keeping partial download: {self.path}")
+            return
+
+        self.remove()
+
+    def remove(self) -> None:
+        for path in (self.path, self._validator_path):
+            try:
+                path.unlink(missing_ok=True)
+            except Exception as e:
+                logger.warning(f"Failed to remove partial download: {path} ({e})")
+
+    def _load_state(self) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(self._validator_path.read_text("utf-8"))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _save_state(self, offset: int) -> None:
+        self._validator_path.write_text(
+            json.dumps({"validator": self._validator, "offset": offset}), "utf-8"
+        )
+
+    def _preallocate(self, offset: int, size: int) -> None:
+        # Reserves the blocks of the file at once, so the file system doesn't
+        # grow it and fragment it write by write
+        if size <= 0 or not hasattr(os, "posix_fallocate"):
+            return
+
+        assert self._file is not None
+        try:
+            os.posix_fallocate(self._file.fileno(), offset, size)
+        except OSError as e:
+            logger.debug(f"Failed to preallocate {self.path} ({e})")
+
+    @staticmethod
+    def _is_encoded(response: urllib3.HTTPResponse) -> bool:
+        return response.headers.get("Content-Encoding", "identity") != "identity"
+
+    @classmethod
+    def _get_validator(cls, response: urllib3.HTTPResponse) -> Optional[str]:
+        # Only an unencoded body is stored byte for byte as it was sent
+        if cls._is_encoded(response):
+            return None
+
+        # Weak ETags can't be used in If-Range
+        etag = response.headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            return etag
+
+        return response.headers.get("Last-Modified")
+
+
+def prune_partial_downloads(folder: Path, max_age: int) -> None:
+    """
+    Removes partial downloads that weren't continued for `max_age` seconds.
+    """
+    if not folder.is_dir():
+        return
+
+    min_mtime = time.time() - max_age
+    for file in folder.iterdir():
+        try:
+            if file.is_file() and file.stat().st_mtime < min_mtime:
+                file.unlink()
+                logger.debug(f"Removed stale partial download: {file}")
+        except Exception as e:
+            logger.warning(f"Failed to remove partial download: {file} ({e})")
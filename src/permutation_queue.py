@@ -0,0 +1,131 @@
+import random
+from typing import Callable, Iterable, Optional, Tuple
+
+from image_info_buffer import ImageInfoBuffer
+
+MASK_64 = (1 << 64) - 1
+
+
+class PermutationQueue:
+    """
+    Queue that yields `items` in a random order without shuffling them. The
+    order is a seeded Feistel permutation over the item indices, so only the
+    seed and the position have to be stored to continue it later. Items that
+    are enqueued afterwards, or that `defer` returns True for when they come
+    up, are yielded in insertion order once the permutation is exhausted.
+    Fresh items (e.g. new posts of a refresh) are yielded before the rest.
+    Items at `skipped_indices` are left out of the permutation.
+    """
+
+    ROUNDS = 6
+
+    def __init__(
+        self,
+        items: ImageInfoBuffer,
+        seed: Optional[int] = None,
+        position: int = 0,
+        defer: Optional[Callable[[str], bool]] = None,
+        skipped_indices: Iterable[int] = (),
+    ) -> None:
+        self.items = items
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.position = min(position, len(items))
+        self.defer = defer
+
+        self.appended = ImageInfoBuffer()
+        self.fresh = ImageInfoBuffer()
+
+        # The permutation works on a power of four covering all indices, with
+        # both halves of an index being the same width
+        self._half_bits = max(1, ((len(items) - 1).bit_length() + 1) // 2)
+        self._half_mask = (1 << self._half_bits) - 1
+
+        key_generator = random.Random(self.seed)
+        self._keys = [key_generator.getrandbits(64) for _ in range(self.ROUNDS)]
+
+        # Skipped items that the position didn't pass yet, to keep the count
+        self._skipped = set(skipped_indices)
+        self._pending_skipped = sum(
+            1 for index in self._skipped if self._unpermute(index) >= self.position
+        )
+
+    @property
+    def count(self) -> int:
+        return (
+            len(self.items)
+            - self.position
+            - self._pending_skipped
+            + len(self.appended)
+            + len(self.fresh)
+        )
+
+    def enqueue(self, item: Tuple[str, str]) -> None:
+        self.appended.append(item)
+
+    def extend(self, items: Iterable[Tuple[str, str]]) -> None:
+        self.appended.extend(items)
+
+    def extend_fresh(self, items: Iterable[Tuple[str, str]]) -> None:
+        self.fresh.extend(items)
+
+    def dequeue(self) -> Tuple[str, str]:
+        while self.fresh:
+            item = self.fresh.popleft()
+            if self.defer and self.defer(item[0]):
+                self.appended.append(item)
+                continue
+
+            return item
+
+        while self.position < len(self.items):
+            index = self._permute(self.position)
+            self.position += 1
+
+            if index in self._skipped:
+                self._pending_skipped -= 1
+                continue
+
+            item = self.items[index]
+
+            if self.defer and self.defer(item[0]):
+                self.appended.append(item)
+                continue
+
+            return item
+
+        if not self.appended:
+            raise IndexError("Queue is empty")
+
+        return self.appended.popleft()
+
+    def _permute(self, index: int) -> int:
+        # Cycle walking: indices outside of the list are permuted again until
+        # they land inside it, which keeps the mapping a bijection
+        while True:
+            left = index >> self._half_bits
+            right = index & self._half_mask
+            for key in self._keys:
+                left, right = right, left ^ self._round(right, key)
+
+            index = (left << self._half_bits) | right
+            if index < len(self.items):
+                return index
+
+    def _unpermute(self, index: int) -> int:
+        # Runs the rounds backwards, walking the cycle the other way
+        while True:
+            left = index >> self._half_bits
+            right = index & self._half_mask
+            for key in reversed(self._keys):
+                left, right = right ^ self._round(left, key), left
+
+            index = (left << self._half_bits) | right
+            if index < len(self.items):
+                return index
+
+    def _round(self, value: int, key: int) -> int:
+        # splitmix64 finalizer
+        value = (value + key) & MASK_64
+        value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+        value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK_64
+        return (value ^ (value >> 31)) & self._half_mask
@@ -0,0 +1,79 @@
+import math
+import threading
+import time
+from typing import Optional
+
+
+class PrefetchScheduler:
+    """
+    Estimates how many downloaded images to keep ahead of the current one, so
+    switching never runs out of images without downloading more than needed.
+    It keeps moving averages (EWMA) of download throughput, image size and
+    time between switches, and asks for enough images to cover the download
+    of the next one at the current switch rate.
+    """
+
+    # Weight of a new sample in the moving averages
+    SMOOTHING = 0.2
+    # Extra images kept ahead for slow downloads and bursts of switches
+    SAFETY_MARGIN = 2
+    # Share of the allowed lookahead that is always kept, as running out of
+    # images wraps the rotation around to old wallpapers
+    MIN_LOOKAHEAD_SHARE = 0.5
+    MIN_SWITCH_INTERVAL = 0.1
+
+    def __init__(self, switch_interval: Optional[int]) -> None:
+        # The timer switches at least this often, longer gaps are pauses
+        self.max_switch_interval = switch_interval
+
+        self._lock = threading.Lock()
+        self._throughput: Optional[float] = None
+        self._image_size: Optional[float] = None
+        self._switch_interval: Optional[float] = (
+            float(switch_interval) if switch_interval else None
+        )
+        self._last_switch: Optional[float] = None
+
+    def on_download(self, size: int, duration: float) -> None:
+        if size <= 0 or duration <= 0:
+            return
+
+        with self._lock:
+            self._throughput = self._update(self._throughput, size / duration)
+            self._image_size = self._update(self._image_size, size)
+
+    def on_switch(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if self._last_switch is not None:
+                interval = max(now - self._last_switch, self.MIN_SWITCH_INTERVAL)
+                if self.max_switch_interval:
+                    interval = min(interval, self.max_switch_interval)
+
+                # Faster switching counts right away, slower switching only
+                # once it lasts, so a burst of switches can't drain the buffer
+                self._switch_interval = min(
+                    interval, self._update(self._switch_interval, interval)
+                )
+
+            self._last_switch = now
+
+    def get_target_lookahead(self, max_lookahead: int) -> int:
+        with self._lock:
+            if not (self._throughput and self._image_size and self._switch_interval):
+                target = self.SAFETY_MARGIN
+            else:
+                download_time = self._image_size / self._throughput
+                target = (
+                    math.ceil(download_time / self._switch_interval)
+                    + self.SAFETY_MARGIN
+                )
+
+        min_lookahead = math.ceil(max_lookahead * self.MIN_LOOKAHEAD_SHARE)
+        return max(0, min(max(target, min_lookahead), max_lookahead))
+
+    def _update(self, average: Optional[float], sample: float) -> float:
+        if average is None:
+            return sample
+
+        return average + self.SMOOTHING * (sample - average)
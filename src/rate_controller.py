@@ -0,0 +1,110 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from logger import logger
+
+
+class RateController:
+    """
+    Shared limit for concurrent requests to Konachan. The limit grows by one
+    after a full window of healthy responses and is halved on throttling,
+    server errors or connection errors (AIMD). These also block new requests
+    for the Retry-After time or an exponential backoff with jitter.
+    """
+
+    BASE_DELAY = 1.0
+    MAX_DELAY = 60.0
+    MAX_RETRY_AFTER = 600.0
+
+    def __init__(self, max_concurrency: int, min_concurrency: int = 1) -> None:
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.limit = max_concurrency
+
+        self._condition = threading.Condition()
+        self._active = 0
+        self._successes = 0
+        self._failures = 0
+        self._blocked_until = 0.0
+
+    def acquire(self, stop_event: Optional[threading.Event] = None) -> bool:
+        """
+        Waits for a free request slot. Returns False if `stop_event` got set
+        while waiting.
+        """
+        with self._condition:
+            while True:
+                if stop_event and stop_event.is_set():
+                    return False
+
+                wait_time = self._blocked_until - time.monotonic()
+                if wait_time <= 0 and self._active < self.limit:
+                    self._active += 1
+                    return True
+
+                # Wake up regularly to notice the stop event
+                self._condition.wait(
+                    timeout=min(wait_time, 1.0) if wait_time > 0 else 1.0
+                )
+
+    def release(self) -> None:
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def on_success(self) -> None:
+        with self._condition:
+            self._failures = 0
+            self._successes += 1
+
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self._successes = 0
+                self.limit += 1
+                logger.debug(f"Request concurrency raised to {self.limit}")
+                self._condition.notify()
+
+    def on_throttled(self, retry_after: Optional[str] = None) -> None:
+        delay = self._parse_retry_after(retry_after)
+        self._back_off(delay)
+
+    def on_error(self) -> None:
+        self._back_off(None)
+
+    def _back_off(self, delay: Optional[float]) -> None:
+        with self._condition:
+            self._successes = 0
+            self._failures += 1
+            self.limit = max(self.min_concurrency, self.limit // 2)
+
+            if delay is None:
+                delay = min(self.BASE_DELAY * 2 ** (self._failures - 1), self.MAX_DELAY)
+                delay = random.uniform(delay / 2, delay)
+
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+
+        logger.warning(
+            f"Backing off requests for {delay:.1f}s (concurrency {self.limit})"
+        )
+
+    def _parse_retry_after(self, retry_after: Optional[str]) -> Optional[float]:
+        if not retry_after:
+            return None
+
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                retry_time = parsedate_to_datetime(retry_after)
+            except (TypeError, ValueError):
+                return None
+
+            if retry_time.tzinfo is None:
+                retry_time = retry_time.replace(tzinfo=timezone.utc)
+
+            delay = (retry_time - datetime.now(timezone.utc)).total_seconds()
+
+        return min(max(delay, 0.0), self.MAX_RETRY_AFTER)
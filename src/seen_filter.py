@@ -0,0 +1,128 @@
+import hashlib
+import math
+import os
+import struct
+import threading
+from typing import List
+
+from constants import SEEN_FILTER
+from logger import logger
+from utils import atomic_write
+
+
+class SeenFilter:
+    """
+    Persistent Bloom filter of image hashes that were already downloaded. It
+    has two generations of `capacity` hashes each: once the current one is
+    full, the older one is dropped, so memory stays bounded and only the most
+    recent hashes are remembered. Lookups may return false positives at about
+    `fp_rate`, but never false negatives for remembered hashes.
+    """
+
+    MAGIC = b"SEEN"
+    VERSION = 1
+    HEADER = struct.Struct("<4sBIdIIII")
+
+    def __init__(self, capacity: int, fp_rate: float, path: str = SEEN_FILTER) -> None:
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.path = path
+        self._lock = threading.Lock()
+
+        self.bit_count = max(
+            8, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)
+        )
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+
+        self._current = bytearray((self.bit_count + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._current_count = 0
+        self._previous_count = 0
+
+    def __contains__(self, image_hash: str) -> bool:
+        positions = self._get_positions(image_hash)
+        with self._lock:
+            return self._has_all(self._current, positions) or self._has_all(
+                self._previous, positions
+            )
+
+    def add(self, image_hash: str) -> None:
+        positions = self._get_positions(image_hash)
+        with self._lock:
+            if self._has_all(self._current, positions):
+                return
+
+            if self._current_count >= self.capacity:
+                self._previous = self._current
+                self._previous_count = self._current_count
+                self._current = bytearray(len(self._previous))
+                self._current_count = 0
+
+            for position in positions:
+                self._current[position >> 3] |= 1 << (position & 7)
+
+            self._current_count += 1
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "rb") as f:
+                header = self.HEADER.unpack(f.read(self.HEADER.size))
+                current = bytearray(f.read(len(self._current)))
+                previous = bytearray(f.read(len(self._previous)))
+        except Exception as e:
+            logger.warning(f"Failed to load seen image history: {e}")
+            return
+
+        magic, version, capacity, fp_rate, bit_count, hash_count, *counts = header
+
+        # A filter with other parameters can't answer lookups for this one
+        if (magic, version, capacity, fp_rate, bit_count, hash_count) != (
+            self.MAGIC,
+            self.VERSION,
+            self.capacity,
+            self.fp_rate,
+            self.bit_count,
+            self.hash_count,
+        ) or len(previous) != len(self._previous):
+            logger.info("Seen image history settings changed, starting a new one")
+            return
+
+        with self._lock:
+            self._current = current
+            self._previous = previous
+            self._current_count, self._previous_count = counts
+
+    def save(self) -> None:
+        with self._lock:
+            header = self.HEADER.pack(
+                self.MAGIC,
+                self.VERSION,
+                self.capacity,
+                self.fp_rate,
+                self.bit_count,
+                self.hash_count,
+                self._current_count,
+                self._previous_count,
+            )
+            data = header + self._current + self._previous
+
+        try:
+            atomic_write(self.path, data)
+        except Exception as e:
+            logger.warning(f"Failed to save seen image history: {e}")
+
+    def _get_positions(self, image_hash: str) -> List[int]:
+        digest = hashlib.blake2b(image_hash.encode("utf-8"), digest_size=16).digest()
+        first, second = struct.unpack("<QQ", digest)
+        second |= 1
+
+        return [(first + i * second) % self.bit_count for i in range(self.hash_count)]
+
+    @staticmethod
+    def _has_all(bits: bytearray, positions: List[int]) -> bool:
+        return all(
+            bits[position >> 3] & (1 << (position & 7)) for position in positions
+        )
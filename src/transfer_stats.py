@@ -0,0 +1,57 @@
+import threading
+from typing import Iterator, Union
+
+import urllib3
+
+
+class TransferStats:
+    """Counts bytes received over the wire and after decompression."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+
+    def add(self, wire_bytes: int, decoded_bytes: int) -> None:
+        with self._lock:
+            self.wire_bytes += wire_bytes
+            self.decoded_bytes += decoded_bytes
+
+    @property
+    def saved_bytes(self) -> int:
+        return max(0, self.decoded_bytes - self.wire_bytes)
+
+
+transfer_stats = TransferStats()
+
+
+def counted_stream(response: urllib3.HTTPResponse, chunk_size: int) -> Iterator[bytes]:
+    """
+    Streams the decoded response body, recording both the compressed bytes
+    read from the socket and the decompressed bytes handed out.
+    """
+    decoded_bytes = 0
+    try:
+        for chunk in response.stream(chunk_size):
+            decoded_bytes += len(chunk)
+            yield chunk
+    finally:
+        transfer_stats.add(response.tell(), decoded_bytes)
+
+
+def counted_readinto(
+    response: urllib3.HTTPResponse, buffer: Union[bytearray, memoryview]
+) -> Iterator[memoryview]:
+    """
+    Reads the decoded response body into `buffer` over and over, handing out
+    the filled part each time, and records the bytes like `counted_stream`.
+    A handed out view is only valid until the next one.
+    """
+    view = memoryview(buffer)
+    decoded_bytes = 0
+    try:
+        while size := response.readinto(view):
+            decoded_bytes += size
+            yield view[:size]
+    finally:
+        transfer_stats.add(response.tell(), decoded_bytes)
@@ -1,13 +1,15 @@
 from datetime import timedelta
+from functools import lru_cache
 import hashlib
 import json
 import os
 import re
+import subprocess
 import sys
 import threading
 import tkinter as tk
 from tkinter import messagebox
-from typing import Any, Dict, List, Optional, cast
+from typing import Any, Dict, List, Optional, Tuple, Union, cast
 
 from constants import IMAGE_INFOS_CACHE
 from logger import logger
@@ -86,12 +88,80 @@ def parse_duration(s: str) -> timedelta:
     return timedelta(days=days, hours=hours, minutes=minutes, seconds=seconds)
 
 
+def parse_resolution(s: str) -> Tuple[int, int]:
+    match = re.fullmatch(r"(\d+)x(\d+)", s.strip())
+    if not match or not all(int(g) for g in match.groups()):
+        raise ValueError(f"Invalid resolution format: {s}")
+
+    return int(match.group(1)), int(match.group(2))
+
+
+@lru_cache(maxsize=None)
+def get_screen_resolution() -> Optional[Tuple[int, int]]:
+    """
+    Returns the size of the primary screen in physical pixels, or None if it
+    can't be detected. Detected once, as on Linux this needs a Tk instance of
+    its own, so the first call has to come before the toast thread starts.
+    """
+    try:
+        if sys.platform == "win32":
+            # Unlike GetSystemMetrics, the desktop size of the device context
+            # is in physical pixels whatever the DPI awareness of the process
+            user32 = ctypes.windll.user32
+            gdi32 = ctypes.windll.gdi32
+            hdc = user32.GetDC(0)
+            try:
+                # DESKTOPHORZRES, DESKTOPVERTRES
+                width = gdi32.GetDeviceCaps(hdc, 118)
+                height = gdi32.GetDeviceCaps(hdc, 117)
+            finally:
+                user32.ReleaseDC(0, hdc)
+        elif sys.platform == "darwin":
+            # Tk reports scaled points on Retina screens
+            output = subprocess.run(
+                ["system_profiler", "SPDisplaysDataType"],
+                capture_output=True,
+                text=True,
+                timeout=30,
+            ).stdout
+            match = re.search(r"Resolution: (\d+) x (\d+)", output)
+            if not match:
+                return None
+
+            width, height = int(match.group(1)), int(match.group(2))
+        else:
+            root = tk.Tk()
+            root.withdraw()
+            width, height = root.winfo_screenwidth(), root.winfo_screenheight()
+            root.destroy()
+    except Exception as e:
+        logger.warning(f"Failed to detect screen resolution: {e}")
+        return None
+
+    return (width, height) if width > 0 and height > 0 else None
+
+
+def get_search_hash(
+    tags: str,
+    min_score: Optional[int],
+    max_image_size: Optional[int],
+) -> str:
+    key = {
+        "tags": tags,
+        "min_score": min_score,
+        "max_image_size": max_image_size,
+    }
+
+    return hashlib.md5(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
 def get_queries_ratings_hash(
     queries: List[str],
     ratings: List[str],
     min_score: Optional[int],
     max_image_size: Optional[int],
 ) -> str:
+    # Key of the single cache.json of the first release, kept to migrate it
     key = {
         "queries": sorted(queries),
         "ratings": sorted(ratings),
@@ -102,6 +172,39 @@ def get_queries_ratings_hash(
     return hashlib.md5(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
 
 
+def get_snapshot_key(
+    partition_keys: List[str],
+    cached_wallpapers_path: str,
+    max_images: int,
+    is_weighted: bool,
+) -> str:
+    key = {
+        "partitions": partition_keys,
+        "cached_wallpapers_path": cached_wallpapers_path,
+        "max_images": max_images,
+        "is_weighted": is_weighted,
+    }
+
+    return hashlib.md5(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def split_url(url: str) -> Tuple[str, str]:
+    """
+    Splits an URL after its first path segment, so posts from the same host
+    share one stored prefix.
+    """
+    host_start = url.find("://") + 3
+    path_start = url.find("/", host_start)
+    if path_start == -1:
+        return url, ""
+
+    prefix_end = url.find("/", path_start + 1)
+    if prefix_end == -1:
+        return url[: path_start + 1], url[path_start + 1 :]
+
+    return url[: prefix_end + 1], url[prefix_end + 1 :]
+
+
 def load_image_infos_cache() -> Dict[str, Any]:
     if not os.path.exists(IMAGE_INFOS_CACHE):
         logger.warning("No image info cache found")
@@ -112,7 +215,17 @@ def load_image_infos_cache() -> Dict[str, Any]:
         return cast(Dict[str, Any], json.load(f))
 
 
-def save_image_infos_cache(cache: Dict[str, Any]) -> None:
-    logger.debug("Saving image info cache...")
-    with open(IMAGE_INFOS_CACHE, "w", encoding="utf-8") as f:
-        json.dump(cache, f)
+def atomic_write(path: str, data: Union[str, bytes]) -> None:
+    """
+    Writes a file next to the old one first and then replaces it, so a crash
+    never leaves a half written file behind.
+    """
+    temp_path = f"{path}.tmp"
+    if isinstance(data, str):
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+    else:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+
+    os.replace(temp_path, path)
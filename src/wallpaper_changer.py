@@ -1,25 +1,56 @@
 import os
+import json
+import multiprocessing
 import random
 import shutil
 import threading
-from datetime import datetime, timezone
-from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 import urllib3
 
-from api import fetch_and_cache_all_image_infos
+from api import PostInfo, SearchPlan, fetch_and_cache_all_image_infos, plan_searches
 from config import Config
+from constants import (
+    ACCEPT_ENCODING,
+    MIN_REFRESH_DELAY,
+    PARTIAL_DOWNLOAD_MAX_AGE,
+    PARTIAL_DOWNLOADS_FOLDER,
+    SEEN_IMAGE_WEIGHT_FACTOR,
+    SNAPSHOT_INTERVAL,
+    STATE_SNAPSHOT,
+    STATE_SNAPSHOT_VERSION,
+)
 from donwloaded_images_list import DownloadedImagesList
-from fixed_size_queue import FixedSizeQueue
+from image_info_buffer import ImageInfoBuffer
+from image_resizer import is_resizing_available, resize_image
 from logger import logger
+from metadata_store import (
+    CachedImageInfo,
+    ImageVariant,
+    MetadataStore,
+    SearchRecord,
+    get_legacy_search_key,
+)
+from permutation_queue import PermutationQueue
+from prefetch_scheduler import PrefetchScheduler
+from rate_controller import RateController
+from seen_filter import SeenFilter
 from toasts import ToastManager
+from partial_download import PartialDownload, prune_partial_downloads
+from transfer_stats import counted_readinto, transfer_stats
 from utils import (
+    atomic_write,
     get_queries_ratings_hash,
-    load_image_infos_cache,
-    save_image_infos_cache,
+    get_screen_resolution,
+    get_search_hash,
+    get_snapshot_key,
     show_error,
 )
 from wallpaper import set_wallpaper
+from weighted_queue import WeightedQueue
 
 
 class WallpaperChanger:
@@ -27,6 +58,11 @@ class WallpaperChanger:
         self.config = config
         self.config.cached_wallpapers_path.mkdir(exist_ok=True)
 
+        self._partial_downloads_path = (
+            self.config.cached_wallpapers_path / PARTIAL_DOWNLOADS_FOLDER
+        )
+        prune_partial_downloads(self._partial_downloads_path, PARTIAL_DOWNLOAD_MAX_AGE)
+
         self.threshold = int(config.max_images * config.old_images_threshold)
 
         self.paused = config.paused_on_startup
@@ -40,25 +76,86 @@ class WallpaperChanger:
         self._auto_image_switch_lock = threading.Lock()
         self._auto_image_switch_event = threading.Event()
         self._auto_image_switch_time: Optional[datetime] = None
+        self._auto_image_switch_deadline: Optional[datetime] = None
         if self.enabled and not self.paused:
             self._set_auto_image_switch_event()
 
         self._fetch_event = threading.Event()
         self._fetch_event.set()
+        self._prefetch_scheduler = PrefetchScheduler(config.image_switch_interval)
+
+        # Shared by image info fetching and image downloads, so throttling
+        # on either side slows both down
+        self._rate_controller = RateController(config.fetch_workers)
 
         self.downloaded_images: DownloadedImagesList[Tuple[str, str, str]] = (
             DownloadedImagesList()
         )
 
-        self.image_queue: FixedSizeQueue[Tuple[str, str]] = FixedSizeQueue([])
+        self._is_weighted = bool(config.score_weight or config.recency_half_life)
+        self.image_queue: Union[PermutationQueue, WeightedQueue] = PermutationQueue(
+            ImageInfoBuffer()
+        )
+        self._queue_lock = threading.Lock()
+
+        self._metadata_store = MetadataStore()
+
+        self._target_resolution = config.target_resolution
+        if config.target_resolution_str == "auto":
+            self._target_resolution = get_screen_resolution()
+            if self._target_resolution:
+                logger.info(
+                    f"Downloading images for {self._target_resolution[0]}x"
+                    f"{self._target_resolution[1]} screen"
+                )
+            else:
+                logger.warning(
+                    "Couldn't detect the screen resolution, downloading original images"
+                )
+
+        # Resizing decodes whole images, so it runs in other processes to
+        # keep it off the threads of this one
+        self._resize_executor: Optional[ProcessPoolExecutor] = None
+        if config.resize_images:
+            if not is_resizing_available():
+                logger.warning("Pillow is not installed, images won't be resized")
+            elif not self._target_resolution:
+                logger.warning("No target resolution, images won't be resized")
+            else:
+                self._resize_executor = ProcessPoolExecutor(
+                    max_workers=min(config.download_workers, os.cpu_count() or 1),
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+
+        self._seen_filter: Optional[SeenFilter] = None
+        if config.seen_history_size:
+            self._seen_filter = SeenFilter(
+                config.seen_history_size, config.seen_history_fp_rate
+            )
+            self._seen_filter.load()
+
+        self._snapshot_key = ""
+        self._snapshot_time = time.monotonic()
+        # Hotkeys and the switch timer save snapshots from different threads
+        self._snapshot_lock = threading.Lock()
+        self._queue_fingerprint = ""
+        self._restored_auto_image_switch_time: Optional[datetime] = None
+
+        self._image_infos_thread: Optional[threading.Thread] = None
         self._load_image_infos()
 
+        if self._restored_auto_image_switch_time and self.enabled and not self.paused:
+            self._set_auto_image_switch_event(self._restored_auto_image_switch_time)
+
         if self.enabled:
             self.set_current_wallpaper()
 
         self._fetch_thread = threading.Thread(target=self._fetch_loop, daemon=True)
         self._fetch_thread.start()
 
+        if self._image_infos_thread:
+            self._image_infos_thread.start()
+
         self._auto_image_switch_thread: Optional[threading.Thread] = None
         if config.image_switch_interval:
             self._auto_image_switch_thread = threading.Thread(
@@ -66,72 +163,155 @@ class WallpaperChanger:
             )
             self._auto_image_switch_thread.start()
 
+    def _get_partition_key(self, tags: str) -> str:
+        return get_search_hash(tags, self.config.min_score, self.config.max_image_size)
+
+    def _is_search_expired(self, search: SearchRecord) -> bool:
+        # Searches that never finished are always fetched again
+        if not search.fetched_at:
+            return True
+
+        if not self.config.cache_refresh_interval:
+            return False
+
+        current_time = datetime.now(timezone.utc)
+        stored_time = datetime.fromtimestamp(search.fetched_at, tz=timezone.utc)
+
+        return current_time > stored_time + self.config.cache_refresh_interval
+
+    def _get_image_weight(
+        self, score: Optional[int], created_at: Optional[int]
+    ) -> float:
+        weight = (max(score or 0, 0) + 1) ** self.config.score_weight
+
+        if self.config.recency_half_life and created_at:
+            age = datetime.now(timezone.utc).timestamp() - created_at
+            half_lives = age / self.config.recency_half_life.total_seconds()
+
+            # Capped so very old posts keep a small but nonzero chance
+            weight *= 0.5 ** min(max(half_lives, 0.0), 64.0)
+
+        return weight
+
     def _load_image_infos(self) -> None:
-        cache_hash = get_queries_ratings_hash(
+        # Every planned search has its own cache partition, so a config change
+        # only fetches the searches that are new and keeps the rest
+        searches = self._metadata_store.get_searches()
+        cached_plans = [
+            search.plan
+            for key, search in searches.items()
+            if key == self._get_partition_key(search.plan.tags)
+        ]
+
+        plans = plan_searches(
             self.config.queries,
             self.config.ratings,
             self.config.min_score,
-            self.config.max_image_size,
+            self.config.max_pages_to_search,
+            cached_plans,
         )
 
-        cache = load_image_infos_cache()
+        cached_keys: List[str] = []
+        expired_plans: List[SearchPlan] = []
+        keep_unknown_files = False
+        for plan in plans:
+            key = self._get_partition_key(plan.tags)
+            search = searches.get(key)
+            if search is None:
+                # Without image info for this search we can't tell which
+                # files are still wanted yet, so keep them and let them rotate
+                keep_unknown_files = True
+                expired_plans.append(plan)
+                continue
 
-        cache_expired = False
-        if self.config.cache_refresh_interval:
-            stored_timestamp = cache.get("timestamp")
-            if stored_timestamp:
-                current_time = datetime.now(timezone.utc)
-                stored_time = datetime.fromtimestamp(stored_timestamp, tz=timezone.utc)
-                cache_expired = (
-                    current_time > stored_time + self.config.cache_refresh_interval
-                )
-            else:
-                cache_expired = True
+            cached_keys.append(key)
+            if self._is_search_expired(search):
+                expired_plans.append(plan)
 
-        if not cache_expired and cache.get("hash") == cache_hash:
-            logger.info("Using cached image info")
-            image_infos = cache.get("data", {})
+        # Posts migrated from the cache.json of the first release stand in for
+        # the searches that weren't fetched yet
+        legacy_key = get_legacy_search_key(
+            get_queries_ratings_hash(
+                self.config.queries,
+                self.config.ratings,
+                self.config.min_score,
+                self.config.max_image_size,
+            )
+        )
+        if keep_unknown_files and legacy_key in searches:
+            cached_keys.append(legacy_key)
+
+        image_infos = self._metadata_store.get_image_infos(cached_keys)
 
+        if not expired_plans:
+            logger.info("Using cached image info")
             self._show_toast("Wallpaper changer started")
         else:
-            logger.info("Fetching new image info...")
             self._show_toast(
                 "Wallpaper changer started. Fetching new image info...",
                 None,
             )
 
-            image_infos = fetch_and_cache_all_image_infos(
-                self.config.queries,
-                self.config.ratings,
-                self.config.min_score,
-                self.config.max_pages_to_search,
-                self.config.search_page_limit,
-                self.config.max_image_size,
+        # Cached image info is always used right away. Image info is fetched
+        # in the background and fed into the queue page by page, so rotation
+        # never waits for the network
+        if expired_plans or self.config.cache_refresh_interval:
+            self._image_infos_thread = threading.Thread(
+                target=self._refresh_image_infos,
+                args=(plans, searches, set(image_infos)),
+                daemon=True,
             )
 
-            save_image_infos_cache(
-                {
-                    "hash": cache_hash,
-                    "data": image_infos,
-                    "timestamp": int(datetime.now(timezone.utc).timestamp()),
-                }
+        logger.info(f"Total cached images: {len(image_infos)}")
+
+        # A snapshot of the last run is only valid for the same searches and
+        # wallpaper folder
+        self._snapshot_key = get_snapshot_key(
+            sorted(self._get_partition_key(plan.tags) for plan in plans),
+            str(self.config.cached_wallpapers_path.resolve()),
+            self.config.max_images,
+            self._is_weighted,
+        )
+        snapshot = self._load_snapshot()
+
+        # The permutation runs over all cached posts, so its saved position
+        # stays valid whichever of them are downloaded right now
+        image_info_buffer: Optional[ImageInfoBuffer] = None
+        image_hashes: List[str] = []
+        if not self._is_weighted:
+            image_info_buffer = ImageInfoBuffer(
+                (image_hash, image_info.url)
+                for image_hash, image_info in image_infos.items()
             )
+            image_hashes = list(image_infos)
+
+        if snapshot is None or not self._restore_downloaded_images(
+            snapshot, image_infos
+        ):
+            snapshot = None
+            self._scan_downloaded_images(image_infos, keep_unknown_files)
 
-            self._show_toast("All image info fetched")
+        self._build_image_queue(image_infos, snapshot, image_info_buffer, image_hashes)
 
-        logger.info(f"Total images: {len(image_infos)}")
+        logger.debug(f"Loaded {len(self.downloaded_images)} images from folder")
 
+    def _scan_downloaded_images(
+        self, image_infos: Dict[str, CachedImageInfo], keep_unknown_files: bool
+    ) -> None:
         temp_images_list: List[Tuple[str, str, str, float]] = []
         for file in self.config.cached_wallpapers_path.iterdir():
             if file.is_file():
                 image_hash = file.stem
-                image_url = image_infos.get(image_hash)
-                if image_url and len(temp_images_list) < self.config.max_images:
+                image_info = image_infos.get(image_hash)
+                image_url = image_info.url if image_info else None
+                if (image_url or keep_unknown_files) and len(
+                    temp_images_list
+                ) < self.config.max_images:
                     creation_time = file.stat().st_ctime
                     temp_images_list.append(
-                        (image_hash, str(file), image_url, creation_time)
+                        (image_hash, str(file), image_url or "", creation_time)
                     )
-                    del image_infos[image_hash]
+                    image_infos.pop(image_hash, None)
                 else:
                     file.unlink()
 
@@ -145,129 +325,636 @@ class WallpaperChanger:
         for _ in range(moves):
             self.downloaded_images.move_next()
 
-        image_info_list = list(image_infos.items())
-        random.shuffle(image_info_list)
+    def _restore_downloaded_images(
+        self, snapshot: Dict[str, Any], image_infos: Dict[str, CachedImageInfo]
+    ) -> bool:
+        entries = [tuple(entry) for entry in snapshot["downloaded"]]
+        if not all(os.path.isfile(image_path) for _, image_path, _ in entries):
+            logger.info("Wallpaper folder changed since the last run, rescanning it")
+            return False
 
-        self.image_queue = FixedSizeQueue(image_info_list)
+        image_paths = {image_path for _, image_path, _ in entries}
+        for file in self.config.cached_wallpapers_path.iterdir():
+            if file.is_file() and str(file) not in image_paths:
+                file.unlink()
 
-        logger.debug(f"Loaded {len(self.downloaded_images)} images from folder")
+        self.downloaded_images = DownloadedImagesList.from_iterable(entries)
+        for _ in range(snapshot["position"]):
+            self.downloaded_images.move_next()
 
-    def _fetch_loop(self) -> None:
-        delay = 1
-        max_delay = 60
+        for image_hash, _, _ in entries:
+            image_infos.pop(image_hash, None)
 
-        http = urllib3.PoolManager()
+        deadline = snapshot.get("auto_image_switch_deadline")
+        if deadline and self.config.image_switch_interval:
+            # The switch timer counts from the last switch
+            self._restored_auto_image_switch_time = datetime.fromtimestamp(
+                deadline
+            ) - timedelta(seconds=self.config.image_switch_interval)
 
-        while True:
-            self._fetch_event.wait()
-            if self._exit_event.is_set():
-                break
+        return True
+
+    def _build_image_queue(
+        self,
+        image_infos: Dict[str, CachedImageInfo],
+        snapshot: Optional[Dict[str, Any]],
+        image_info_buffer: Optional[ImageInfoBuffer],
+        image_hashes: List[str],
+    ) -> None:
+        if self._is_weighted:
+            # Images downloaded in earlier runs are picked last
+            seen_infos: List[Tuple[str, CachedImageInfo]] = []
+            if self._seen_filter:
+                seen_hashes = [
+                    image_hash
+                    for image_hash in image_infos
+                    if image_hash in self._seen_filter
+                ]
+                seen_infos = [
+                    (image_hash, image_infos.pop(image_hash))
+                    for image_hash in seen_hashes
+                ]
+                logger.debug(f"{len(seen_infos)} cached image(s) were seen before")
+
+            weighted_queue = WeightedQueue(
+                ImageInfoBuffer(
+                    (image_hash, image_info.url)
+                    for image_hash, image_info in image_infos.items()
+                ),
+                (
+                    self._get_image_weight(image_info.score, image_info.created_at)
+                    for image_info in image_infos.values()
+                ),
+            )
+            weighted_queue.extend(
+                ((image_hash, image_info.url) for image_hash, image_info in seen_infos),
+                (
+                    self._get_image_weight(image_info.score, image_info.created_at)
+                    * SEEN_IMAGE_WEIGHT_FACTOR
+                    for _, image_info in seen_infos
+                ),
+            )
+            self.image_queue = weighted_queue
+            return
+
+        assert image_info_buffer is not None
+        self._queue_fingerprint = image_info_buffer.get_fingerprint()
+
+        # Downloaded images are left out of the permutation, they are enqueued
+        # again once they are rotated out
+        downloaded_hashes = set()
+        node = self.downloaded_images.head
+        while node:
+            downloaded_hashes.add(node.value[0])
+            node = node.next
+
+        skipped_indices = [
+            index
+            for index, image_hash in enumerate(image_hashes)
+            if image_hash in downloaded_hashes
+        ]
+
+        # Images downloaded in earlier runs go to the back of the queue when
+        # they come up
+        seen_filter = self._seen_filter
+        defer = seen_filter.__contains__ if seen_filter else None
+
+        queue_state = snapshot.get("queue") if snapshot else None
+        if queue_state and queue_state["items"] == self._queue_fingerprint:
+            permutation_queue = PermutationQueue(
+                image_info_buffer,
+                queue_state["seed"],
+                queue_state["position"],
+                defer,
+                skipped_indices,
+            )
+            permutation_queue.extend(tuple(item) for item in queue_state["appended"])
+            permutation_queue.extend_fresh(
+                tuple(item) for item in queue_state.get("fresh", [])
+            )
+            logger.debug("Restored image queue of the last run")
+        else:
+            # The queue walks the list in a random order, so it isn't shuffled
+            permutation_queue = PermutationQueue(
+                image_info_buffer, defer=defer, skipped_indices=skipped_indices
+            )
+
+        self.image_queue = permutation_queue
+
+    def _load_snapshot(self) -> Optional[Dict[str, Any]]:
+        if not os.path.exists(STATE_SNAPSHOT):
+            return None
+
+        try:
+            with open(STATE_SNAPSHOT, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except Exception as e:
+            logger.warning(f"Failed to load state snapshot: {e}")
+            return None
+
+        if (
+            snapshot.get("version") != STATE_SNAPSHOT_VERSION
+            or snapshot.get("key") != self._snapshot_key
+        ):
+            logger.info("State snapshot is stale, rebuilding state")
+            return None
+
+        return snapshot
+
+    def _save_snapshot(self) -> None:
+        with self._lock:
+            downloaded: List[Tuple[str, str, str]] = []
+            node = self.downloaded_images.head
+            while node:
+                downloaded.append(node.value)
+                node = node.next
 
-            current_size = len(self.downloaded_images)
             position = self.downloaded_images.position_from_start
 
-            if current_size < self.config.max_images:
-                to_fetch = self.config.max_images - current_size
-                logger.debug("Not enough images, fetching image(s) to fill batch...")
-            elif position > self.threshold:
-                to_fetch = position - self.threshold
-                logger.debug(
-                    f"Index {position} > {self.threshold} (threshold of batch size), rotating image(s)..."
-                )
-            else:
-                self._fetch_event.clear()
+        queue_state: Optional[Dict[str, Any]] = None
+        with self._queue_lock:
+            queue = self.image_queue
+            if isinstance(queue, PermutationQueue):
+                queue_state = {
+                    "items": self._queue_fingerprint,
+                    "seed": queue.seed,
+                    "position": queue.position,
+                    "appended": [queue.appended[i] for i in range(len(queue.appended))],
+                    "fresh": [queue.fresh[i] for i in range(len(queue.fresh))],
+                }
+
+        deadline: Optional[datetime] = None
+        if self._auto_image_switch_event.is_set():
+            with self._auto_image_switch_lock:
+                deadline = self._auto_image_switch_deadline
+                if self._auto_image_switch_time and self.config.image_switch_interval:
+                    deadline = self._auto_image_switch_time + timedelta(
+                        seconds=self.config.image_switch_interval
+                    )
+
+        snapshot = {
+            "version": STATE_SNAPSHOT_VERSION,
+            "key": self._snapshot_key,
+            "downloaded": downloaded,
+            "position": position,
+            "queue": queue_state,
+            "auto_image_switch_deadline": deadline.timestamp() if deadline else None,
+        }
+
+        with self._snapshot_lock:
+            try:
+                atomic_write(STATE_SNAPSHOT, json.dumps(snapshot))
+            except Exception as e:
+                logger.warning(f"Failed to save state snapshot: {e}")
+                return
+
+            if self._seen_filter:
+                self._seen_filter.save()
+
+            self._snapshot_time = time.monotonic()
+
+    def _save_snapshot_if_due(self) -> None:
+        if time.monotonic() - self._snapshot_time >= SNAPSHOT_INTERVAL:
+            self._save_snapshot()
+
+    def _get_refresh_delay(
+        self, plans: List[SearchPlan], searches: Dict[str, SearchRecord]
+    ) -> Optional[float]:
+        refresh_interval = self.config.cache_refresh_interval
+        if not refresh_interval:
+            return None
+
+        current_time = datetime.now(timezone.utc)
+        next_refresh_time = current_time + refresh_interval
+        for plan in plans:
+            search = searches.get(self._get_partition_key(plan.tags))
+            if search is None:
                 continue
 
-            for _ in range(min(to_fetch, self.image_queue.size)):
+            stored_time = datetime.fromtimestamp(search.fetched_at, tz=timezone.utc)
+            next_refresh_time = min(next_refresh_time, stored_time + refresh_interval)
+
+        # Searches that failed to refresh are retried after a short delay
+        delay = (next_refresh_time - current_time).total_seconds()
+        return max(delay, MIN_REFRESH_DELAY)
+
+    def _refresh_image_infos(
+        self,
+        plans: List[SearchPlan],
+        searches: Dict[str, SearchRecord],
+        known_hashes: Set[str],
+    ) -> None:
+        while True:
+            expired_plans: List[SearchPlan] = []
+            for plan in plans:
+                search = searches.get(self._get_partition_key(plan.tags))
+                if search is None or self._is_search_expired(search):
+                    expired_plans.append(plan)
+
+            if expired_plans:
+                logger.info(
+                    f"Fetching image info for {len(expired_plans)} search(es)..."
+                )
+                self._fetch_image_infos(plans, expired_plans, searches, known_hashes)
                 if self._exit_event.is_set():
                     return
 
-                download_success = False
+                searches = self._metadata_store.get_searches()
 
-                img_hash, img_url = self.image_queue.dequeue()
-                ext = os.path.splitext(img_url)[1]
-                img_path = os.path.join(
-                    self.config.cached_wallpapers_path, f"{img_hash}{ext}"
-                )
-                logger.debug(f"Downloading image: {img_url}")
-                try:
-                    response: urllib3.HTTPResponse = http.request(
-                        "GET", img_url, timeout=30, preload_content=False
-                    )
+            delay = self._get_refresh_delay(plans, searches)
+            if delay is None:
+                return
 
-                    if response.status == 200:
-                        content_length = int(response.headers.get("Content-Length", 0))
-                        downloaded = 0
-
-                        with open(img_path, "wb") as f:
-                            for chunk in response.stream(16384):
-                                f.write(chunk)
-                                downloaded += len(chunk)
-
-                        if content_length and downloaded != content_length:
-                            logger.error(
-                                f"Incomplete download for {img_url}: {downloaded}/{content_length} bytes"
-                            )
-                            self.image_queue.enqueue((img_hash, img_url))
-
-                            try:
-                                if os.path.exists(img_path):
-                                    os.remove(img_path)
-                                    logger.debug(
-                                        f"Removed incomplete downloaded image: {img_path}"
-                                    )
-                            except Exception as e:
-                                logger.warning(
-                                    f"Failed to remove incomplete downloaded image: {img_path} ({e})"
-                                )
-                        else:
-                            download_success = True
-                            logger.debug(f"Saved image: {img_path}")
-                    else:
-                        self.image_queue.enqueue((img_hash, img_url))
-                        logger.error(
-                            f"Failed to download image: {img_url} (status {response.status})"
-                        )
-                except Exception as e:
-                    self.image_queue.enqueue((img_hash, img_url))
-                    logger.error(
-                        f"Error downloading image: {img_url} ({e})", stack_info=True
+            logger.debug(f"Next image info refresh in {delay:.0f}s")
+            if self._exit_event.wait(delay):
+                return
+
+    def _fetch_image_infos(
+        self,
+        plans: List[SearchPlan],
+        expired_plans: List[SearchPlan],
+        searches: Dict[str, SearchRecord],
+        known_hashes: Set[str],
+    ) -> None:
+        with self._lock:
+            node = self.downloaded_images.head
+            while node:
+                known_hashes.add(node.value[0])
+                node = node.next
+
+        def on_page(plan: SearchPlan, page_posts: List[PostInfo]) -> None:
+            # Posts are stored as they arrive, so an interrupted fetch keeps
+            # everything but the last page
+            self._metadata_store.add_posts(
+                self._get_partition_key(plan.tags), plan, page_posts
+            )
+
+            new_posts = [post for post in page_posts if post.md5 not in known_hashes]
+            if not new_posts:
+                return
+
+            known_hashes.update(post.md5 for post in new_posts)
+            random.shuffle(new_posts)
+
+            new_infos = [(post.md5, post.url) for post in new_posts]
+            with self._queue_lock:
+                if isinstance(self.image_queue, WeightedQueue):
+                    self.image_queue.extend(
+                        new_infos,
+                        [
+                            self._get_image_weight(post.score, post.created_at)
+                            for post in new_posts
+                        ],
                     )
+                else:
+                    # New posts come up next instead of after the whole
+                    # permutation
+                    self.image_queue.extend_fresh(new_infos)
+
+                self._fetch_event.set()
+
+        # Expired partitions only fetch posts newer than the ones they have
+        max_ids: Dict[str, int] = {}
+        for plan in expired_plans:
+            search = searches.get(self._get_partition_key(plan.tags))
+            if search:
+                max_ids[plan.tags] = search.max_id
+
+        results = fetch_and_cache_all_image_infos(
+            expired_plans,
+            self.config.min_score,
+            self.config.search_page_limit,
+            self.config.max_image_size,
+            self.config.fetch_workers,
+            max_ids,
+            on_page,
+            self._exit_event,
+            self.config.api_url,
+            self._rate_controller,
+            self._metadata_store.get_posts,
+        )
+
+        if self._exit_event.is_set():
+            return
+
+        timestamp = int(datetime.now(timezone.utc).timestamp())
+        fetched_count = 0
+
+        # Posts are already stored, only the refresh state is left
+        for plan in expired_plans:
+            key = self._get_partition_key(plan.tags)
+            search = searches.get(key)
+            result = results[plan.tags]
+            fetched_count += len(result.posts)
+
+            # Incomplete searches keep their old timestamp to be retried on the
+            # next start
+            fetched_at = timestamp
+            if not result.complete:
+                fetched_at = search.fetched_at if search else 0
+
+            self._metadata_store.save_search(key, plan, result.max_id, fetched_at)
 
-                    if os.path.exists(img_path):
-                        try:
-                            os.remove(img_path)
-                        except Exception:
-                            logger.warning(
-                                f"Failed to remove failed to download image: {img_path} ({e})"
-                            )
-                finally:
-                    response.release_conn()
-
-                if download_success:
+        # Partitions of searches that are no longer planned are dropped
+        self._metadata_store.delete_searches_except(
+            self._get_partition_key(plan.tags) for plan in plans
+        )
+        self._metadata_store.checkpoint()
+
+        logger.info(f"Fetched {fetched_count} image info(s)")
+        self._show_toast("All image info fetched")
+
+    def _fetch_loop(self) -> None:
+        workers = self.config.download_workers
+        http = urllib3.PoolManager(maxsize=workers)
+        in_flight: Set["Future[bool]"] = set()
+
+        # Failed images go back into the queue and would come up again right
+        # away, so every failure in a row doubles the wait before the next
+        # downloads
+        delay = 1
+        max_delay = 60
+
+        # Leaving the executor waits for downloads that are still running
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                self._fetch_event.wait()
+                if self._exit_event.is_set():
+                    break
+
+                # Cleared before looking at the state, so a download finishing
+                # from here on wakes the loop again
+                self._fetch_event.clear()
+
+                done = {future for future in in_flight if future.done()}
+                in_flight -= done
+
+                results = [
+                    future.exception() is None and future.result() for future in done
+                ]
+                if any(results):
                     delay = 1
-                    with self._lock:
-                        self.downloaded_images.append((img_hash, img_path, img_url))
-
-                        while len(self.downloaded_images) > self.config.max_images:
-                            old_img_hash, old_img_path, old_img_url = (
-                                self.downloaded_images.pop()
-                            )
-                            self.image_queue.enqueue((old_img_hash, old_img_url))
-
-                            try:
-                                os.remove(old_img_path)
-                                logger.debug(f"Removed old image: {old_img_path}")
-                            except Exception as e:
-                                logger.warning(
-                                    f"Failed to remove image: {old_img_path} ({e})"
-                                )
-                else:
+
+                if not all(results):
                     if self._exit_event.wait(timeout=delay):
-                        return
+                        break
 
                     delay = min(delay * 2, max_delay)
 
+                # Downloads are topped up as soon as one finishes, instead of
+                # waiting for a whole batch
+                to_fetch = min(
+                    self._get_images_to_fetch() - len(in_flight),
+                    workers - len(in_flight),
+                )
+                if to_fetch <= 0:
+                    continue
+
+                with self._queue_lock:
+                    if not self.image_queue.count:
+                        # Wait for the background image info fetch to add more
+                        logger.debug("Image queue is empty, waiting for image info...")
+                        continue
+
+                    batch = [
+                        self.image_queue.dequeue()
+                        for _ in range(min(to_fetch, self.image_queue.count))
+                    ]
+
+                for img_hash, img_url in batch:
+                    future = executor.submit(
+                        self._download_image, http, img_hash, img_url
+                    )
+                    future.add_done_callback(lambda _: self._fetch_event.set())
+                    in_flight.add(future)
+
+    def _get_images_to_fetch(self) -> int:
+        current_size = len(self.downloaded_images)
+        position = self.downloaded_images.position_from_start
+
+        # Images after the current one, and at most as many as the old images
+        # threshold leaves room for
+        lookahead = current_size - 1 - position
+        max_lookahead = self.config.max_images - 1 - self.threshold
+
+        if self.config.adaptive_prefetch:
+            target = self._prefetch_scheduler.get_target_lookahead(max_lookahead)
+        elif current_size < self.config.max_images:
+            target = self.config.max_images
+        else:
+            target = max_lookahead
+
+        to_fetch = target - lookahead
+        if to_fetch <= 0:
+            return 0
+
+        if current_size < self.config.max_images:
+            logger.debug(
+                f"{max(0, lookahead)} image(s) ahead of {target} wanted, fetching image(s) to fill batch..."
+            )
+            return min(to_fetch, self.config.max_images - current_size)
+
+        # Every new image replaces the oldest one
+        logger.debug(
+            f"{lookahead} image(s) ahead of {target} wanted, rotating image(s)..."
+        )
+        return min(to_fetch, position)
+
+    def _get_image_variant(self, img_hash: str, img_url: str) -> ImageVariant:
+        original = ImageVariant(img_url, None, None, True)
+        if not self._target_resolution:
+            return original
+
+        variants = self._metadata_store.get_image_variants(img_hash)
+
+        # Variants only cover the screen without upscaling if both sides are
+        # at least as large, whatever part of the image is cropped
+        width, height = self._target_resolution
+        covering = [
+            variant
+            for variant in variants
+            if variant.width
+            and variant.height
+            and variant.width >= width
+            and variant.height >= height
+        ]
+        if not covering:
+            return original
+
+        # A variant as large as the original is a JPEG of a PNG original,
+        # which is the smaller file
+        return min(
+            covering,
+            key=lambda variant: (
+                (variant.width or 0) * (variant.height or 0),
+                variant.is_original,
+            ),
+        )
+
+    def _download_image(
+        self, http: urllib3.PoolManager, img_hash: str, img_url: str
+    ) -> bool:
+        """
+        Downloads an image into the wallpaper folder. Returns False if it
+        failed and the image was put back into the queue.
+        """
+        if self._exit_event.is_set():
+            self._enqueue_image(img_hash, img_url)
+            return False
+
+        download_success = False
+
+        variant = self._get_image_variant(img_hash, img_url)
+        ext = os.path.splitext(variant.url)[1]
+        img_path = os.path.join(self.config.cached_wallpapers_path, f"{img_hash}{ext}")
+        if not self._rate_controller.acquire(self._exit_event):
+            self._enqueue_image(img_hash, img_url)
+            return False
+
+        # Images are downloaded into a staging folder and only moved next
+        # to the others once complete
+        partial = PartialDownload(self._partial_downloads_path, f"{img_hash}{ext}")
+
+        logger.debug(f"Downloading image: {variant.url}")
+        start_time = time.monotonic()
+        response: Optional[urllib3.HTTPResponse] = None
+        try:
+            response = http.request(
+                "GET",
+                variant.url,
+                headers=partial.get_request_headers(ACCEPT_ENCODING),
+                timeout=30,
+                preload_content=False,
+            )
+
+            if response.status in (200, 206):
+                content_length = int(response.headers.get("Content-Length", 0))
+
+                # Large reads into one reusable buffer. The read size is what
+                # speeds this up, urllib3 still copies every read once
+                buffer = bytearray(self.config.download_buffer_size)
+                with partial.open(response):
+                    for chunk in counted_readinto(response, buffer):
+                        partial.write(chunk)
+
+                # Content-Length counts the bytes on the wire, which
+                # differ from the written ones if the body is encoded
+                downloaded = response.tell()
+
+                if content_length and downloaded != content_length:
+                    logger.error(
+                        f"Incomplete download for {variant.url}: {downloaded}/{content_length} bytes"
+                    )
+                    self._enqueue_image(img_hash, img_url)
+                    self._rate_controller.on_error()
+                    partial.discard()
+                elif not partial.complete(
+                    img_path, img_hash if variant.is_original else None
+                ):
+                    self._enqueue_image(img_hash, img_url)
+                else:
+                    download_success = True
+                    self._rate_controller.on_success()
+                    self._prefetch_scheduler.on_download(
+                        downloaded, time.monotonic() - start_time
+                    )
+
+                    if self._seen_filter:
+                        self._seen_filter.add(img_hash)
+
+                    logger.debug(f"Saved image: {img_path}")
+            else:
+                self._enqueue_image(img_hash, img_url)
+                logger.error(
+                    f"Failed to download image: {variant.url} (status {response.status})"
+                )
+
+                if response.status == 416:
+                    # The partial download doesn't fit the file anymore
+                    partial.remove()
+
+                # Other client errors (e.g. a missing image) only concern
+                # this image
+                if response.status in (429, 503):
+                    self._rate_controller.on_throttled(
+                        response.headers.get("Retry-After")
+                    )
+                elif response.status >= 500:
+                    self._rate_controller.on_error()
+        except Exception as e:
+            self._enqueue_image(img_hash, img_url)
+            if isinstance(e, urllib3.exceptions.HTTPError):
+                self._rate_controller.on_error()
+            logger.error(
+                f"Error downloading image: {variant.url} ({e})", stack_info=True
+            )
+            partial.discard()
+        finally:
+            if response is not None:
+                # Whatever is left of the body is read first, otherwise the
+                # next request on the reused connection would get it as its
+                # response
+                response.drain_conn()
+                response.release_conn()
+
+            self._rate_controller.release()
+
+        if not download_success:
+            return False
+
+        if self._resize_executor:
+            img_path = self._resize_image(img_hash, img_path)
+
+        with self._lock:
+            self.downloaded_images.append((img_hash, img_path, img_url))
+
+            while len(self.downloaded_images) > self.config.max_images:
+                old_img_hash, old_img_path, old_img_url = self.downloaded_images.pop()
+                self._enqueue_image(old_img_hash, old_img_url)
+
+                try:
+                    os.remove(old_img_path)
+                    logger.debug(f"Removed old image: {old_img_path}")
+                except Exception as e:
+                    logger.warning(f"Failed to remove image: {old_img_path} ({e})")
+
+            # Show the first image as soon as it is downloaded
+            if self.enabled and self.current_wallpaper is None:
+                self.set_current_wallpaper()
+
+        return True
+
+    def _resize_image(self, img_hash: str, img_path: str) -> str:
+        assert self._resize_executor and self._target_resolution
+
+        width, height = self._target_resolution
+        temp_path = os.path.join(self._partial_downloads_path, f"{img_hash}.resized")
+        try:
+            resized_path = self._resize_executor.submit(
+                resize_image,
+                img_path,
+                temp_path,
+                width,
+                height,
+                self.config.resize_quality,
+            ).result()
+        except Exception as e:
+            logger.warning(f"Failed to resize image: {img_path} ({e})")
+            return img_path
+
+        if resized_path != img_path:
+            logger.debug(f"Resized image: {resized_path}")
+
+        return resized_path
+
+    def _enqueue_image(self, img_hash: str, img_url: str) -> None:
+        # Images kept from the folder without known image info have no url
+        if not img_url:
+            return
+
+        with self._queue_lock:
+            self.image_queue.enqueue((img_hash, img_url))
+
     def _set_wallpaper(self, img_path: str) -> None:
         if img_path == self.current_wallpaper:
             return
@@ -310,10 +997,13 @@ class WallpaperChanger:
 
             logger.debug("Switching to next image")
 
+            self._prefetch_scheduler.on_switch()
             self.downloaded_images.move_next()
             self.set_current_wallpaper()
             self._fetch_event.set()
 
+        self._save_snapshot_if_due()
+
     def next_image_by_hotkey(self) -> None:
         if not self.enabled:
             return
@@ -400,6 +1090,20 @@ class WallpaperChanger:
 
         self._fetch_thread.join()
 
+        if self._resize_executor:
+            self._resize_executor.shutdown()
+
+        if self._image_infos_thread:
+            self._image_infos_thread.join()
+
+        self._metadata_store.close()
+        self._save_snapshot()
+
+        logger.info(
+            f"Received {transfer_stats.wire_bytes} bytes, "
+            f"{transfer_stats.saved_bytes} bytes saved by compression"
+        )
+
     def toggle_pause(self) -> None:
         if not self.enabled:
             return
@@ -448,6 +1152,10 @@ class WallpaperChanger:
                 else:
                     sleep_time = self.config.image_switch_interval
 
+                self._auto_image_switch_deadline = datetime.now() + timedelta(
+                    seconds=sleep_time
+                )
+
             if self._exit_event.wait(timeout=sleep_time):
                 break
 
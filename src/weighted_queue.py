@@ -0,0 +1,131 @@
+import random
+from array import array
+from typing import Dict, Iterable, Tuple
+
+from image_info_buffer import ImageInfoBuffer
+
+
+class WeightedQueue:
+    """
+    Queue that yields `items` at random with a chance proportional to their
+    weight, without repeats until they are enqueued again. Weights are kept in
+    a Fenwick tree, so drawing, removing and restoring an item are O(log n).
+    """
+
+    def __init__(self, items: ImageInfoBuffer, weights: Iterable[float]) -> None:
+        self.items = items
+
+        self._weights = array("d", weights)
+        if len(self._weights) != len(items):
+            raise ValueError("Every item needs a weight")
+
+        self._active = bytearray(b"\x01" * len(items))
+        self._count = len(items)
+        self._weight_sum = sum(self._weights)
+
+        # Items taken out of the queue, to restore their weight when they are
+        # enqueued again
+        self._taken: Dict[str, int] = {}
+
+        self._build_tree()
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def enqueue(self, item: Tuple[str, str]) -> None:
+        index = self._taken.pop(item[0], None)
+        if index is None:
+            # Items that never were in the queue get the average weight
+            self.append(
+                item,
+                self._weight_sum / len(self._weights) if self._weights else 1.0,
+            )
+            return
+
+        self._active[index] = 1
+        self._count += 1
+        self._add(index, self._weights[index])
+
+    def extend(
+        self, items: Iterable[Tuple[str, str]], weights: Iterable[float]
+    ) -> None:
+        for item, weight in zip(items, weights):
+            self.append(item, weight)
+
+    def append(self, item: Tuple[str, str], weight: float) -> None:
+        self.items.append(item)
+        self._weights.append(weight)
+        self._active.append(1)
+        self._count += 1
+        self._weight_sum += weight
+
+        # A new tree node covers the range of its lowest set bit
+        index = len(self._tree)
+        low_bit = index & -index
+        self._tree.append(
+            weight + self._prefix_sum(index - 1) - self._prefix_sum(index - low_bit)
+        )
+
+    def dequeue(self) -> Tuple[str, str]:
+        if not self._count:
+            raise IndexError("Queue is empty")
+
+        while True:
+            index = self._find(random.random() * self._prefix_sum(len(self._weights)))
+            if self._active[index]:
+                break
+
+            # Rounding errors in the tree may point at a removed item
+            self._build_tree()
+
+        item = self.items[index]
+
+        self._active[index] = 0
+        self._count -= 1
+        self._add(index, -self._weights[index])
+        self._taken[item[0]] = index
+
+        return item
+
+    def _build_tree(self) -> None:
+        size = len(self._weights)
+        tree = array("d", [0.0]) * (size + 1)
+        for index in range(size):
+            if self._active[index]:
+                tree[index + 1] = self._weights[index]
+
+        for node in range(1, size + 1):
+            parent = node + (node & -node)
+            if parent <= size:
+                tree[parent] += tree[node]
+
+        self._tree = tree
+
+    def _add(self, index: int, delta: float) -> None:
+        node = index + 1
+        while node < len(self._tree):
+            self._tree[node] += delta
+            node += node & -node
+
+    def _prefix_sum(self, count: int) -> float:
+        total = 0.0
+        while count > 0:
+            total += self._tree[count]
+            count -= count & -count
+
+        return total
+
+    def _find(self, target: float) -> int:
+        # Descends the tree to the first item whose cumulative weight exceeds
+        # the target
+        index = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            node = index + step
+            if node < len(self._tree) and self._tree[node] <= target:
+                index = node
+                target -= self._tree[node]
+            step >>= 1
+
+        return min(index, len(self._weights) - 1)
@@ -0,0 +1,272 @@
+import json
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+import urllib3
+
+from api import (
+    PostInfo,
+    ResponseCache,
+    SearchPlan,
+    _count_separate_requests,
+    fetch_and_cache_all_image_infos,
+    fetch_image_infos,
+    plan_searches,
+)
+from rate_controller import RateController
+
+PER_PAGE = 10
+
+
+def make_post(md5: str, rating: str, tags: str) -> PostInfo:
+    return PostInfo(
+        md5, f"https://example.com/{md5}.png", *[None] * 4, rating, tags, *[None] * 7
+    )
+
+
+def test_plan_folds_ratings_and_queries():
+    plans = plan_searches(["a", "b", "c"], ["s", "q", "e"], max_pages=10)
+
+    assert len(plans) == 1
+    assert plans[0].tags == "~a ~b ~c"
+    assert len(plans[0].pairs) == 9
+    assert plans[0].max_pages == 90
+
+
+def test_plan_rating_filter():
+    assert plan_searches(["a", "b"], ["s"])[0].tags == "~a ~b rating:s"
+    assert plan_searches(["a", "b"], ["s", "q"])[0].tags == "~a ~b -rating:e"
+
+
+def test_plan_keeps_complex_queries_apart():
+    plans = plan_searches(["a", "b c", "-d", "e*", "f"], ["s", "q", "e"])
+
+    assert [plan.tags for plan in plans] == ["~a ~f", "b c", "-d", "e*"]
+
+
+def test_plan_respects_tag_limit():
+    queries = [f"tag{index}" for index in range(7)]
+    plans = plan_searches(queries, ["s"], min_score=10)
+
+    # Rating, score and id filters leave room for three tags per search
+    assert [plan.tags.split()[:-1] for plan in plans] == [
+        ["~tag0", "~tag1", "~tag2"],
+        ["~tag3", "~tag4", "~tag5"],
+        ["tag6"],
+    ]
+
+
+def test_plan_reuses_cached_searches():
+    cached = SearchPlan("a rating:s", [("a", "s")], 10)
+    plans = plan_searches(["a", "b"], ["s", "q"], reusable_plans=[cached])
+
+    assert plans[0] == cached
+    assert {pair for plan in plans for pair in plan.pairs} == {
+        ("a", "s"),
+        ("a", "q"),
+        ("b", "s"),
+        ("b", "q"),
+    }
+    assert sorted(plan.tags for plan in plans[1:]) == ["a rating:q", "b -rating:e"]
+
+
+def test_plan_drops_cached_searches_with_unwanted_pairs():
+    cached = SearchPlan("~a ~b", [("a", "s"), ("b", "s")], 20)
+    plans = plan_searches(["a"], ["s"], reusable_plans=[cached])
+
+    assert cached not in plans
+
+
+def test_count_separate_requests():
+    plan = plan_searches(["a", "b"], ["s", "q"], max_pages=2)[0]
+    posts = [make_post(f"{index:032x}", "s", "a") for index in range(250)]
+    posts.append(make_post("f" * 32, "q", "b"))
+
+    # (a, s) is capped at 2 pages, the others need one request each
+    assert _count_separate_requests(plan, posts, 100) == 2 + 1 + 1 + 1
+
+
+def serve_posts(handler, pages: int = 5, count: int = PER_PAGE) -> None:
+    page = int(parse_qs(urlsplit(handler.path).query)["page"][0])
+    posts = []
+    if page <= pages:
+        for index in range((page - 1) * PER_PAGE, (page - 1) * PER_PAGE + count):
+            post_id = 1000 - index
+            posts.append(
+                {
+                    "id": post_id,
+                    "md5": f"{post_id:032x}",
+                    "file_url": f"https://example.com/{post_id:032x}.png",
+                    "rating": "s",
+                    "tags": "a",
+                }
+            )
+
+    body = json.dumps(posts).encode("utf-8")
+    handler.send_response(200)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def test_fetch_all_pages(serve, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    url = serve(serve_posts)
+    plan = SearchPlan("a", [("a", "s")], 10)
+
+    results = fetch_and_cache_all_image_infos(
+        [plan], per_page=PER_PAGE, workers=3, api_url=url
+    )
+
+    assert len(results["a"].posts) == 5 * PER_PAGE
+    assert results["a"].max_id == 1000
+    assert results["a"].complete
+
+
+def test_fetch_stopped_part_way(serve, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    url = serve(serve_posts)
+    plan = SearchPlan("a", [("a", "s")], 10)
+    stop_event = threading.Event()
+
+    results = fetch_and_cache_all_image_infos(
+        [plan],
+        per_page=PER_PAGE,
+        workers=1,
+        on_page=lambda plan, posts: stop_event.set(),
+        stop_event=stop_event,
+        api_url=url,
+    )
+
+    # Older posts were never fetched, so the refresh mark must not move
+    assert len(results["a"].posts) == PER_PAGE
+    assert results["a"].max_id == 0
+    assert not results["a"].complete
+
+
+def test_fetch_stops_at_short_page(serve, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    requests = []
+
+    def handle(handler) -> None:
+        requests.append(handler.path)
+        serve_posts(handler, pages=1, count=3)
+
+    url = serve(handle)
+    plan = SearchPlan("a", [("a", "s")], 10)
+
+    results = fetch_and_cache_all_image_infos(
+        [plan], per_page=PER_PAGE, workers=8, api_url=url
+    )
+
+    assert len(results["a"].posts) == 3
+    assert results["a"].complete
+    assert len(requests) == 1
+
+
+def load_posts_from(posts):
+    return lambda hashes: {post.md5: post for post in posts if post.md5 in hashes}
+
+
+def test_response_cache_keeps_unused_entries(tmp_path):
+    path = str(tmp_path / "response_cache.json")
+    result = (1, 5, [make_post("a" * 32, "s", "a")])
+    load_posts = load_posts_from(result[2])
+
+    cache = ResponseCache(load_posts, path)
+    cache.put("https://example.com/?tags=a", None, '"1"', None, result)
+    cache.put("https://example.com/?tags=b", None, '"2"', None, result)
+    cache.save()
+
+    # A run that only refreshes one search keeps the other one
+    cache = ResponseCache(load_posts, path)
+    cache.load()
+    assert cache.get("https://example.com/?tags=a", None)
+    cache.save()
+
+    cache = ResponseCache(load_posts, path)
+    cache.load()
+    cached = cache.get("https://example.com/?tags=b", None)
+    assert cached and cached.etag == '"2"'
+    assert cached.result == result
+
+
+def test_response_cache_stores_only_hashes(tmp_path):
+    path = tmp_path / "response_cache.json"
+    post = make_post("a" * 32, "s", "a")
+
+    cache = ResponseCache(load_posts_from([]), str(path))
+    cache.put("https://example.com/?tags=a", None, '"1"', None, (1, 5, [post]))
+    cache.save()
+
+    assert post.url not in path.read_text("utf-8")
+
+    # Without its posts a page can't be answered from the cache
+    assert cache.get("https://example.com/?tags=a", None) is None
+
+
+def test_response_cache_replaces_moved_id_filter(tmp_path):
+    cache = ResponseCache(load_posts_from([]), str(tmp_path / "response_cache.json"))
+    result = (0, 0, [])
+    cache.put("https://example.com/?tags=a+id:>5", None, '"1"', None, result)
+    cache.put("https://example.com/?tags=a+id:>9", None, '"2"', None, result)
+
+    assert cache.get("https://example.com/?tags=a+id:>5", None) is None
+    assert cache.get("https://example.com/?tags=a+id:>9", None)
+    assert cache.get("https://example.com/?tags=a+id:>9", 100) is None
+
+
+def test_response_cache_save_error(tmp_path):
+    cache = ResponseCache(
+        load_posts_from([]), str(tmp_path / "missing" / "response_cache.json")
+    )
+    cache.put("https://example.com/?tags=a", None, '"1"', None, (0, 0, []))
+
+    cache.save()
+
+
+def test_client_error_does_not_back_off(serve):
+    def not_found(handler) -> None:
+        handler.send_response(404)
+        handler.send_header("Content-Length", "0")
+        handler.end_headers()
+
+    url = serve(not_found)
+    controller = RateController(4)
+
+    result = fetch_image_infos(
+        urllib3.PoolManager(), "a", api_url=url, rate_controller=controller
+    )
+
+    assert result is None
+    assert controller.limit == 4
+    assert controller._blocked_until == 0
+
+
+def test_error_body_keeps_connection_reusable(serve):
+    ports = []
+
+    def handle(handler) -> None:
+        ports.append(handler.client_address[1])
+        if "page=1&" in handler.path:
+            # Larger than the socket buffers, so most of it is left unread
+            body = b"x" * 1000000
+            handler.send_response(404)
+            handler.send_header("Content-Length", str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+        else:
+            serve_posts(handler)
+
+    url = serve(handle)
+    http = urllib3.PoolManager(maxsize=1)
+
+    assert fetch_image_infos(http, "a", page=1, api_url=url) is None
+
+    result = fetch_image_infos(http, "a", page=2, per_page=PER_PAGE, api_url=url)
+    assert result is not None
+    assert result[0] == PER_PAGE
+
+    # The unread error page is drained, so both requests share a connection
+    assert len(set(ports)) == 1
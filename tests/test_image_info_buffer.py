@@ -0,0 +1,83 @@
+import pytest
+
+from image_info_buffer import ImageInfoBuffer
+
+
+def make_item(index: int):
+    image_hash = f"{index:032x}"
+    return (
+        image_hash,
+        f"https://konachan.com/image/{image_hash}/Konachan.com%20-%20{index}.png",
+    )
+
+
+def test_grows_past_capacity():
+    buffer = ImageInfoBuffer()
+    items = [make_item(i) for i in range(100)]
+    buffer.extend(items)
+
+    assert len(buffer) == 100
+    assert buffer.capacity >= 100
+    assert [buffer[i] for i in range(100)] == items
+
+
+def test_wraps_around():
+    buffer = ImageInfoBuffer(make_item(i) for i in range(16))
+    assert buffer.capacity == 16
+
+    for i in range(10):
+        assert buffer.popleft() == make_item(i)
+    buffer.extend(make_item(i) for i in range(16, 26))
+
+    # The new items reuse the freed slots at the start
+    assert buffer.capacity == 16
+    assert buffer.start == 10
+    assert [buffer[i] for i in range(16)] == [make_item(i) for i in range(10, 26)]
+
+
+def test_grows_while_wrapped():
+    buffer = ImageInfoBuffer(make_item(i) for i in range(16))
+    for i in range(5):
+        buffer.popleft()
+    buffer.extend(make_item(i) for i in range(16, 30))
+
+    assert buffer.capacity == 32
+    assert [buffer[i] for i in range(len(buffer))] == [
+        make_item(i) for i in range(5, 30)
+    ]
+
+
+def test_keeps_urls_without_md5():
+    items = [
+        (f"{1:032x}", "https://example.com/other.jpg"),
+        (f"{2:032x}", "https://example.com/"),
+    ]
+
+    assert list(ImageInfoBuffer(items)[i] for i in range(2)) == items
+
+
+def test_index_out_of_range():
+    buffer = ImageInfoBuffer([make_item(1)])
+
+    with pytest.raises(IndexError):
+        buffer[1]
+
+    buffer.popleft()
+    with pytest.raises(IndexError):
+        buffer.popleft()
+
+
+def test_fingerprint_follows_items():
+    wrapped = ImageInfoBuffer(make_item(i) for i in range(16))
+    for i in range(4):
+        wrapped.popleft()
+    wrapped.extend(make_item(i) for i in range(16, 20))
+
+    assert (
+        wrapped.get_fingerprint()
+        == ImageInfoBuffer(make_item(i) for i in range(4, 20)).get_fingerprint()
+    )
+    assert (
+        wrapped.get_fingerprint()
+        != ImageInfoBuffer(make_item(i) for i in range(16)).get_fingerprint()
+    )
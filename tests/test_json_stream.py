@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from api import _iter_json_array
+
+ITEMS = [
+    {"id": 12345, "tags": "café 東方 ✓", "score": -1.5e3, "nested": [1, {"a": None}]},
+    {"id": 2, "tags": 'quote " and \\ escape', "rating": "s"},
+    [],
+    "text",
+    67890,
+    True,
+]
+
+
+def split(data: bytes, size: int):
+    return [data[index : index + size] for index in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 4096])
+def test_decodes_across_chunk_boundaries(size):
+    data = json.dumps(ITEMS, ensure_ascii=False, indent=1).encode("utf-8")
+
+    assert list(_iter_json_array(split(data, size))) == ITEMS
+
+
+def test_decodes_at_every_split_point():
+    data = json.dumps(ITEMS, ensure_ascii=False).encode("utf-8")
+
+    for index in range(len(data)):
+        assert list(_iter_json_array([data[:index], data[index:]])) == ITEMS
+
+
+def test_empty_array():
+    assert list(_iter_json_array([b" [ ", b"]"])) == []
+
+
+def test_yields_items_before_the_end():
+    items = _iter_json_array(iter([b'[{"id": 1},', b'{"id": 2}']))
+
+    assert next(items) == {"id": 1}
+    with pytest.raises(ValueError):
+        next(items)
+
+
+def test_rejects_other_documents():
+    with pytest.raises(ValueError):
+        list(_iter_json_array([b'{"id": 1}']))
+
+
+def test_rejects_truncated_array():
+    with pytest.raises(ValueError):
+        list(_iter_json_array([b'[{"id": 1}, {"id"']))
@@ -0,0 +1,70 @@
+import json
+
+from api import PostInfo, SearchPlan
+from metadata_store import MetadataStore, get_legacy_search_key
+from utils import get_queries_ratings_hash
+
+MD5 = "0123456789abcdef0123456789abcdef"
+URL = f"https://konachan.com/image/{MD5}/Konachan.com%20-%201.png"
+
+
+def test_migrates_baseline_json_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache_hash = get_queries_ratings_hash(["a", "b"], ["s"], None, None)
+    with open("cache.json", "w", encoding="utf-8") as f:
+        json.dump({"hash": cache_hash, "data": {MD5: URL}, "timestamp": 1700000000}, f)
+
+    store = MetadataStore("cache.db")
+    key = get_legacy_search_key(cache_hash)
+
+    assert not (tmp_path / "cache.json").exists()
+    assert store.get_searches()[key].fetched_at == 1700000000
+    assert store.get_image_infos([key])[MD5].url == URL
+
+    # Dropped once the planned searches replace it
+    store.delete_searches_except(["other"])
+    assert key not in store.get_searches()
+    assert store.get_image_infos([key]) == {}
+
+    store.close()
+
+
+def test_keeps_broken_json_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "cache.json").write_text("{", "utf-8")
+
+    MetadataStore("cache.db").close()
+
+    assert (tmp_path / "cache.json").exists()
+
+
+def test_stores_posts_and_variants(tmp_path):
+    store = MetadataStore(str(tmp_path / "cache.db"))
+    plan = SearchPlan("a", [("a", "s")], 10)
+    post = PostInfo(
+        MD5,
+        URL,
+        1000,
+        5,
+        4000,
+        3000,
+        "s",
+        "a",
+        1700000000,
+        *[f"https://konachan.com/jpeg/{MD5}.jpg", 4000, 3000],
+        *[f"https://konachan.com/sample/{MD5}.jpg", 1500, 1125],
+    )
+    store.add_posts("key", plan, [post])
+    store.save_search("key", plan, 7, 1700000000)
+
+    info = store.get_image_infos(["key"])[MD5]
+    assert (info.url, info.score, info.created_at) == (URL, 5, 1700000000)
+    assert [variant.width for variant in store.get_image_variants(MD5)] == [
+        4000,
+        4000,
+        1500,
+    ]
+    assert store.get_searches()["key"].max_id == 7
+    assert store.get_posts([MD5, "0" * 32]) == {MD5: post}
+
+    store.close()
@@ -0,0 +1,178 @@
+import hashlib
+import os
+import re
+
+import pytest
+import urllib3
+
+import partial_download
+from partial_download import PartialDownload, prune_partial_downloads
+
+BODY = os.urandom(256 * 1024)
+MD5 = hashlib.md5(BODY).hexdigest()
+ETAG = '"abc"'
+RANGE_PATTERN = re.compile(r"bytes=(\d+)-")
+
+
+def make_server(serve, requests, content_range=None, etag=ETAG, truncate_at=None):
+    def do_get(handler) -> None:
+        requests.append(dict(handler.headers))
+
+        match = RANGE_PATTERN.fullmatch(handler.headers.get("Range", ""))
+        if match and handler.headers.get("If-Range") == etag:
+            start = int(match.group(1))
+            body = BODY[start:]
+            handler.send_response(206)
+            handler.send_header(
+                "Content-Range",
+                content_range or f"bytes {start}-{len(BODY) - 1}/{len(BODY)}",
+            )
+        else:
+            body = BODY
+            handler.send_response(200)
+
+        handler.send_header("ETag", etag)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+
+        if truncate_at is not None and not match:
+            handler.wfile.write(body[:truncate_at])
+            handler.close_connection = True
+            return
+
+        handler.wfile.write(body)
+
+    return serve(do_get) + "/image.png"
+
+
+def download(url, partial):
+    http = urllib3.PoolManager(retries=False)
+    response = http.request(
+        "GET",
+        url,
+        headers=partial.get_request_headers("gzip"),
+        preload_content=False,
+    )
+    try:
+        with partial.open(response):
+            for chunk in response.stream(16384):
+                partial.write(chunk)
+    finally:
+        response.release_conn()
+
+
+def test_complete_download(serve, tmp_path):
+    url = make_server(serve, [])
+    partial = PartialDownload(tmp_path / ".partial", "image.png")
+
+    download(url, partial)
+
+    destination = str(tmp_path / "image.png")
+    assert partial.complete(destination, MD5)
+    assert open(destination, "rb").read() == BODY
+    assert os.listdir(tmp_path / ".partial") == []
+
+
+def test_resumes_with_range(serve, tmp_path):
+    requests = []
+    url = make_server(serve, requests, truncate_at=100000)
+    partial = PartialDownload(tmp_path, "image.png")
+
+    with pytest.raises(urllib3.exceptions.HTTPError):
+        download(url, partial)
+    partial.discard()
+
+    # The chunk that broke off isn't written
+    offset = partial.offset
+    assert 0 < offset <= 100000
+
+    partial = PartialDownload(tmp_path, "image.png")
+    download(url, partial)
+
+    assert requests[-1]["Range"] == f"bytes={offset}-"
+    assert requests[-1]["If-Range"] == ETAG
+    assert requests[-1]["Accept-Encoding"] == "identity"
+
+    # The digest covers the bytes of both runs
+    assert partial.hexdigest() == MD5
+    assert partial.complete(str(tmp_path / "done.png"), MD5)
+
+
+def test_starts_over_when_file_changed(serve, tmp_path):
+    url = make_server(serve, [], truncate_at=100000)
+    partial = PartialDownload(tmp_path, "image.png")
+    with pytest.raises(urllib3.exceptions.HTTPError):
+        download(url, partial)
+    partial.discard()
+
+    # A new ETag doesn't match If-Range, so the whole file is sent again
+    url = make_server(serve, [], etag='"new"')
+    partial = PartialDownload(tmp_path, "image.png")
+    download(url, partial)
+
+    assert partial.hexdigest() == MD5
+    assert (tmp_path / "image.png").stat().st_size == len(BODY)
+
+
+def test_unexpected_range_removes_partial(serve, tmp_path):
+    url = make_server(serve, [], truncate_at=100000)
+    partial = PartialDownload(tmp_path, "image.png")
+    with pytest.raises(urllib3.exceptions.HTTPError):
+        download(url, partial)
+    partial.discard()
+
+    url = make_server(serve, [], content_range=f"bytes 0-{len(BODY) - 1}/{len(BODY)}")
+    partial = PartialDownload(tmp_path, "image.png")
+    with pytest.raises(ValueError):
+        download(url, partial)
+    partial.discard()
+
+    assert partial.offset == 0
+    assert os.listdir(tmp_path) == []
+
+
+def test_md5_mismatch_removes_file(serve, tmp_path):
+    url = make_server(serve, [])
+    partial = PartialDownload(tmp_path, "image.png")
+    download(url, partial)
+
+    assert not partial.complete(str(tmp_path / "done.png"), "0" * 32)
+    assert os.listdir(tmp_path) == []
+
+
+def test_prune_partial_downloads(tmp_path):
+    old_file = tmp_path / "old.png"
+    new_file = tmp_path / "new.png"
+    old_file.write_bytes(b"old")
+    new_file.write_bytes(b"new")
+    os.utime(old_file, (0, 0))
+
+    prune_partial_downloads(tmp_path, 60)
+
+    assert os.listdir(tmp_path) == ["new.png"]
+
+
+def test_resumes_after_crash_from_checkpoint(serve, tmp_path, monkeypatch):
+    monkeypatch.setattr(partial_download, "CHECKPOINT_SIZE", 64 * 1024)
+    requests = []
+    url = make_server(serve, requests)
+
+    # A crash leaves the file at its preallocated size without truncating it
+    partial = PartialDownload(tmp_path, "image.png")
+    http = urllib3.PoolManager()
+    response = http.request("GET", url, preload_content=False)
+    partial.open(response)
+    for chunk in response.stream(16 * 1024):
+        partial.write(chunk)
+        if partial._written > 150000:
+            break
+    partial._file.close()
+    response.release_conn()
+
+    partial = PartialDownload(tmp_path, "image.png")
+    assert partial.offset == 2 * 64 * 1024
+
+    download(url, partial)
+
+    assert requests[-1]["Range"] == f"bytes={2 * 64 * 1024}-"
+    assert partial.hexdigest() == MD5
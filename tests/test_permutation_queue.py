@@ -0,0 +1,109 @@
+import pytest
+
+from image_info_buffer import ImageInfoBuffer
+from permutation_queue import PermutationQueue
+
+
+def make_item(index: int):
+    image_hash = f"{index:032x}"
+    return image_hash, f"https://example.com/{image_hash}.png"
+
+
+def drain(queue: PermutationQueue):
+    items = []
+    while queue.count:
+        items.append(queue.dequeue())
+
+    return items
+
+
+def test_fresh_items_come_first():
+    queue = PermutationQueue(ImageInfoBuffer(make_item(i) for i in range(10)))
+    first = queue.dequeue()
+    queue.enqueue(first)
+    queue.extend_fresh([make_item(100), make_item(101)])
+
+    assert queue.count == 12
+    assert queue.dequeue() == make_item(100)
+    assert queue.dequeue() == make_item(101)
+
+    # Enqueued items still wait for the end of the permutation
+    assert drain(queue)[-1] == first
+
+
+def test_fresh_items_can_be_deferred():
+    seen = {make_item(100)[0]}
+    queue = PermutationQueue(ImageInfoBuffer([make_item(1)]), defer=seen.__contains__)
+    queue.extend_fresh([make_item(100), make_item(101)])
+
+    assert drain(queue) == [make_item(101), make_item(1), make_item(100)]
+
+
+def test_permutation_is_a_bijection():
+    for size in (1, 2, 3, 5, 16, 17, 100, 1000):
+        queue = PermutationQueue(ImageInfoBuffer(make_item(i) for i in range(size)))
+
+        assert sorted(queue._permute(i) for i in range(size)) == list(range(size))
+        assert sorted(drain(queue)) == [make_item(i) for i in range(size)]
+
+
+def test_permutation_shuffles():
+    items = [make_item(i) for i in range(1000)]
+    queue = PermutationQueue(ImageInfoBuffer(items), seed=1)
+
+    assert drain(queue) != items
+
+
+def test_same_seed_gives_same_order():
+    items = [make_item(i) for i in range(500)]
+    first = drain(PermutationQueue(ImageInfoBuffer(items), seed=42))
+
+    assert drain(PermutationQueue(ImageInfoBuffer(items), seed=42)) == first
+    assert drain(PermutationQueue(ImageInfoBuffer(items), seed=43)) != first
+
+
+def test_continues_from_position():
+    items = [make_item(i) for i in range(500)]
+    queue = PermutationQueue(ImageInfoBuffer(items), seed=7)
+    order = drain(queue)
+
+    restored = PermutationQueue(ImageInfoBuffer(items), seed=7, position=200)
+    assert drain(restored) == order[200:]
+
+
+def test_empty_queue():
+    queue = PermutationQueue(ImageInfoBuffer())
+
+    assert queue.count == 0
+    with pytest.raises(IndexError):
+        queue.dequeue()
+
+
+def test_unpermute_inverts_permute():
+    queue = PermutationQueue(ImageInfoBuffer(make_item(i) for i in range(300)))
+
+    assert all(queue._unpermute(queue._permute(i)) == i for i in range(300))
+
+
+def test_skipped_items_are_left_out():
+    items = [make_item(i) for i in range(100)]
+    skipped = [3, 50, 99]
+    queue = PermutationQueue(ImageInfoBuffer(items), seed=5, skipped_indices=skipped)
+
+    assert queue.count == 97
+    assert sorted(drain(queue)) == [
+        item for i, item in enumerate(items) if i not in skipped
+    ]
+
+
+def test_skipped_items_keep_positions():
+    items = [make_item(i) for i in range(100)]
+    order = drain(PermutationQueue(ImageInfoBuffer(items), seed=9))
+    skipped = [items.index(order[10]), items.index(order[60])]
+
+    # A queue restored past one skipped item only counts the other one
+    restored = PermutationQueue(
+        ImageInfoBuffer(items), seed=9, position=40, skipped_indices=skipped
+    )
+    assert restored.count == 59
+    assert drain(restored) == [item for item in order[40:] if item != order[60]]
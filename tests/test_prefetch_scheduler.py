@@ -0,0 +1,26 @@
+from prefetch_scheduler import PrefetchScheduler
+
+
+def test_keeps_half_of_the_lookahead_without_samples():
+    scheduler = PrefetchScheduler(60)
+
+    assert scheduler.get_target_lookahead(10) == 5
+    assert scheduler.get_target_lookahead(3) == 2
+    assert scheduler.get_target_lookahead(0) == 0
+
+
+def test_fast_downloads_keep_the_minimum():
+    scheduler = PrefetchScheduler(60)
+    scheduler.on_download(1_000_000, 0.1)
+
+    assert scheduler.get_target_lookahead(20) == 10
+
+
+def test_slow_downloads_buffer_more():
+    scheduler = PrefetchScheduler(10)
+
+    # 50 s per image at one switch every 10 s needs 5 images plus the margin
+    scheduler.on_download(5_000_000, 50.0)
+
+    assert scheduler.get_target_lookahead(10) == 5 + PrefetchScheduler.SAFETY_MARGIN
+    assert scheduler.get_target_lookahead(6) == 6
@@ -0,0 +1,90 @@
+import threading
+import time
+from email.utils import formatdate
+
+from rate_controller import RateController
+
+
+def test_error_halves_limit():
+    controller = RateController(8)
+    controller.on_error()
+    assert controller.limit == 4
+
+    controller.on_error()
+    controller.on_error()
+    controller.on_error()
+    assert controller.limit == 1
+
+
+def test_error_keeps_min_concurrency():
+    controller = RateController(8, min_concurrency=3)
+    controller.on_error()
+    controller.on_error()
+
+    assert controller.limit == 3
+
+
+def test_successes_raise_limit_by_one_per_window():
+    controller = RateController(4)
+    controller.on_error()
+    assert controller.limit == 2
+
+    controller.on_success()
+    assert controller.limit == 2
+
+    controller.on_success()
+    assert controller.limit == 3
+
+    for _ in range(3):
+        controller.on_success()
+    assert controller.limit == 4
+
+    # The limit never grows past the maximum
+    for _ in range(10):
+        controller.on_success()
+    assert controller.limit == 4
+
+
+def test_error_resets_success_window():
+    controller = RateController(4)
+    controller.on_error()
+    controller.on_success()
+    controller.on_error()
+    controller.on_success()
+
+    assert controller.limit == 2
+
+
+def test_throttling_blocks_for_retry_after():
+    controller = RateController(2)
+    controller.on_throttled("5")
+
+    assert controller.limit == 1
+    assert 4 < controller._blocked_until - time.monotonic() <= 5
+
+
+def test_retry_after_parsing():
+    controller = RateController(1)
+
+    assert controller._parse_retry_after(None) is None
+    assert controller._parse_retry_after("invalid") is None
+    assert controller._parse_retry_after("-5") == 0
+    assert controller._parse_retry_after("99999") == RateController.MAX_RETRY_AFTER
+
+    delay = controller._parse_retry_after(formatdate(time.time() + 30, usegmt=True))
+    assert delay is not None and 25 < delay <= 30
+
+
+def test_acquire_respects_limit():
+    controller = RateController(2)
+    stop_event = threading.Event()
+
+    assert controller.acquire(stop_event)
+    assert controller.acquire(stop_event)
+
+    stop_event.set()
+    assert not controller.acquire(stop_event)
+
+    controller.release()
+    stop_event.clear()
+    assert controller.acquire(stop_event)
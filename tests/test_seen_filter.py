@@ -0,0 +1,56 @@
+from seen_filter import SeenFilter
+
+
+def make_hash(index: int) -> str:
+    return f"{index:032x}"
+
+
+def test_remembers_added_hashes(tmp_path):
+    seen = SeenFilter(100, 0.01, str(tmp_path / "seen.bin"))
+    seen.add(make_hash(1))
+
+    assert make_hash(1) in seen
+    assert make_hash(2) not in seen
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "seen.bin")
+    seen = SeenFilter(100, 0.01, path)
+    for index in range(50):
+        seen.add(make_hash(index))
+    seen.save()
+
+    loaded = SeenFilter(100, 0.01, path)
+    loaded.load()
+
+    assert all(make_hash(index) in loaded for index in range(50))
+    assert sum(make_hash(index) in loaded for index in range(1000, 2000)) < 50
+
+
+def test_load_ignores_other_settings(tmp_path):
+    path = str(tmp_path / "seen.bin")
+    seen = SeenFilter(100, 0.01, path)
+    seen.add(make_hash(1))
+    seen.save()
+
+    loaded = SeenFilter(200, 0.01, path)
+    loaded.load()
+
+    assert make_hash(1) not in loaded
+
+
+def test_load_without_file(tmp_path):
+    seen = SeenFilter(100, 0.01, str(tmp_path / "missing.bin"))
+    seen.load()
+
+    assert make_hash(1) not in seen
+
+
+def test_drops_oldest_generation(tmp_path):
+    seen = SeenFilter(10, 0.001, str(tmp_path / "seen.bin"))
+    for index in range(21):
+        seen.add(make_hash(index))
+
+    # The first generation was dropped when the third one started
+    assert sum(make_hash(index) in seen for index in range(10)) < 3
+    assert all(make_hash(index) in seen for index in range(10, 21))
@@ -0,0 +1,69 @@
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+import wallpaper_changer
+from config import Config
+from wallpaper_changer import WallpaperChanger
+
+
+def test_failed_downloads_back_off(serve, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(wallpaper_changer, "set_wallpaper", lambda *args: True)
+
+    image_requests = []
+    lock = threading.Lock()
+
+    def handle(handler):
+        if urlsplit(handler.path).path != "/post.json":
+            with lock:
+                image_requests.append(handler.path)
+
+            handler.send_response(404)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+
+        host = handler.headers["Host"]
+        posts = [
+            {
+                "id": post_id,
+                "md5": f"{post_id:032x}",
+                "file_url": f"http://{host}/{post_id:032x}.png",
+                "file_size": 1000,
+                "rating": "s",
+                "tags": "a",
+            }
+            for post_id in range(5, 0, -1)
+        ]
+
+        body = json.dumps(posts).encode("utf-8")
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    url = serve(handle)
+    config = Config(
+        show_toasts=False,
+        queries=["a"],
+        ratings=["s"],
+        api_url=f"{url}/post.json",
+        cached_wallpapers_path=tmp_path / "cached",
+        user_saved_wallpapers_path=tmp_path / "saved",
+        max_pages_to_search=2,
+        adaptive_prefetch=False,
+        seen_history_size=0,
+    )
+
+    changer = WallpaperChanger(config)
+    try:
+        time.sleep(3)
+    finally:
+        changer.exit()
+
+    # Waits of 1 and 2 seconds after the first failures leave room for only
+    # a few rounds of downloads
+    assert 0 < len(image_requests) <= 4 * config.download_workers
@@ -0,0 +1,93 @@
+import random
+from collections import Counter
+
+import pytest
+
+from image_info_buffer import ImageInfoBuffer
+from weighted_queue import WeightedQueue
+
+
+def make_item(index: int):
+    image_hash = f"{index:032x}"
+    return image_hash, f"https://example.com/{image_hash}.png"
+
+
+def make_queue(weights):
+    items = ImageInfoBuffer(make_item(i) for i in range(len(weights)))
+    return WeightedQueue(items, weights)
+
+
+def test_yields_every_item_once():
+    queue = make_queue([1.0, 5.0, 0.5, 2.0, 3.0])
+    items = [queue.dequeue() for _ in range(5)]
+
+    assert sorted(items) == [make_item(i) for i in range(5)]
+    assert queue.count == 0
+    with pytest.raises(IndexError):
+        queue.dequeue()
+
+
+def test_samples_by_weight():
+    random.seed(0)
+    first_items = Counter()
+    for _ in range(4000):
+        first_items[make_queue([1.0, 3.0, 0.0, 4.0]).dequeue()] += 1
+
+    assert first_items[make_item(2)] == 0
+    assert 0.10 < first_items[make_item(0)] / 4000 < 0.15
+    assert 0.33 < first_items[make_item(1)] / 4000 < 0.42
+    assert 0.45 < first_items[make_item(3)] / 4000 < 0.55
+
+
+def test_removed_items_are_not_drawn_until_enqueued():
+    random.seed(1)
+    queue = make_queue([100.0, 1.0, 1.0])
+    heavy = make_item(0)
+    while queue.dequeue() != heavy:
+        pass
+
+    remaining = [queue.dequeue() for _ in range(queue.count)]
+    assert heavy not in remaining
+
+    queue.enqueue(heavy)
+    assert queue.count == 1
+    assert queue.dequeue() == heavy
+
+
+def test_enqueue_restores_weight():
+    random.seed(2)
+    queue = make_queue([1.0, 1000.0])
+    queue.enqueue(queue.dequeue())
+    queue.enqueue(queue.dequeue())
+
+    heavy_count = 0
+    for _ in range(200):
+        item = queue.dequeue()
+        heavy_count += item == make_item(1)
+        queue.enqueue(item)
+
+    assert heavy_count > 190
+
+
+def test_appended_items_join_the_tree():
+    queue = make_queue([1.0, 2.0, 3.0])
+    queue.extend([make_item(i) for i in range(3, 20)], [float(i) for i in range(3, 20)])
+    queue.enqueue(make_item(20))
+
+    items = [queue.dequeue() for _ in range(21)]
+    assert sorted(items) == [make_item(i) for i in range(21)]
+
+
+def test_prefix_sums_match_weights():
+    weights = [random.random() for _ in range(37)]
+    queue = make_queue(weights)
+    queue.extend([make_item(i) for i in range(37, 50)], [1.0] * 13)
+    all_weights = weights + [1.0] * 13
+
+    for count in range(len(all_weights) + 1):
+        assert queue._prefix_sum(count) == pytest.approx(sum(all_weights[:count]))
+
+
+def test_needs_a_weight_per_item():
+    with pytest.raises(ValueError):
+        WeightedQueue(ImageInfoBuffer([make_item(1)]), [])